@@ -1,4 +1,100 @@
-import os, tarfile, zipfile, tempfile
+import os, io, gzip, lzma, tarfile, zipfile, tempfile, shutil, collections
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 64 * 1024
+
+class HashingReader:
+	def __init__(self, io, hash):
+		self.io = io
+		self.hash = hash
+
+	def read(self, size = -1):
+		data = self.io.read(size)
+		self.hash.update(data)
+		return data
+
+# a symlink adds its target path to a package Id instead of the contents
+# it points to, which clients could not reproduce from the archive alone
+def hash_link(hash, target):
+	hash.update(target.encode('utf-8'))
+
+# member names and link targets must stay inside the directory a
+# package is installed into
+def is_safe(name):
+	parts = name.replace('\\', '/').split('/')
+	return not name.startswith(('/', '\\')) and ':' not in parts[0] and '..' not in parts
+
+def is_safe_link(name, target):
+	if target.startswith(('/', '\\')) or ':' in target.split('/')[0]: return False
+	depth = len(name.split('/')) - 1
+	for part in target.replace('\\', '/').split('/'):
+		if part == '..': depth -= 1
+		elif part not in ('', '.'): depth += 1
+		if depth < 0: return False
+	return True
+
+# a name can be safe on its own and still leave the prefix through links
+# unpacked before it, so the parent of every member is resolved on disk
+def is_inside(prefix, path):
+	prefix = os.path.realpath(prefix)
+	path = os.path.realpath(path)
+	return path == prefix or path.startswith(prefix.rstrip(os.sep) + os.sep)
+
+# replaces whatever is at dest, without following a link that is there
+def make_link(target, dest):
+	if os.path.lexists(dest): os.remove(dest)
+	os.symlink(target, dest)
+
+def gzip_block(data, level):
+	if level is None: level = 9
+	return gzip.compress(data, level, mtime=0)
+
+def xz_block(data, level):
+	if level is None: level = 6
+	return lzma.compress(data, preset=level)
+
+class BlockWriter:
+	# Compresses independent blocks on a thread pool and writes them out
+	# in order. Concatenated gzip members and xz streams are valid files
+	# of their own, so the result reads back with tarfile's 'r:*'.
+	codecs = {
+		'gz': (gzip_block, 1024 * 1024),
+		'xz': (xz_block, 4 * 1024 * 1024),
+	}
+
+	def __init__(self, path, kind, level, threads):
+		self.compress, self.block_size = BlockWriter.codecs[kind]
+		self.level = level
+		self.out = io.open(path, 'wb')
+		self.pool = ThreadPoolExecutor(max_workers=threads)
+		self.pending = collections.deque()
+		self.limit = threads * 2
+		self.buffer = []
+		self.buffered = 0
+
+	def write(self, data):
+		self.buffer.append(data)
+		self.buffered += len(data)
+		if self.buffered >= self.block_size:
+			self.flush_block()
+		return len(data)
+
+	def flush_block(self):
+		block = b''.join(self.buffer)
+		self.buffer = []
+		self.buffered = 0
+		self.pending.append(self.pool.submit(self.compress, block, self.level))
+		while len(self.pending) > self.limit:
+			self.out.write(self.pending.popleft().result())
+
+	def close(self):
+		try:
+			if self.buffered: self.flush_block()
+			while self.pending:
+				self.out.write(self.pending.popleft().result())
+		finally:
+			self.pool.shutdown()
+			self.out.close()
 
 class Archive:
 	def __init__(self):
@@ -8,10 +104,49 @@ class Archive:
 	def close(self): return self.impl.close()
 
 class Tar(Archive):
-	def __init__(self, path, mode = 'r'):
+	def __init__(self, path, mode = 'r', level = None, threads = 1):
 		Archive.__init__(self)
-		self.impl = tarfile.open(path, mode)
-	def add(self, path, arcname): self.impl.add(path, arcname)
+		self.stream = None
+		kind = mode.split(':', 1)[1] if ':' in mode else ''
+		if mode[:1] != 'w':
+			self.impl = tarfile.open(path, mode)
+		elif threads > 1 and kind in BlockWriter.codecs:
+			self.stream = BlockWriter(path, kind, level, threads)
+			self.impl = tarfile.open(fileobj=self.stream, mode='w|')
+		elif level is not None and kind == 'xz':
+			self.impl = tarfile.open(path, mode, preset=level)
+		elif level is not None and kind:
+			self.impl = tarfile.open(path, mode, compresslevel=level)
+		else:
+			self.impl = tarfile.open(path, mode)
+	def extractall(self, dir): extract_tar(self.impl, dir)
+	def close(self):
+		self.impl.close()
+		if self.stream is not None: self.stream.close()
+	# returns the link target if path was stored as a symlink
+	def add(self, path, arcname, hash = None):
+		if hash is None:
+			self.impl.add(path, arcname)
+			return None
+		if os.path.islink(path):
+			info = self.impl.gettarinfo(path, arcname)
+			hash_link(hash, info.linkname)
+			self.impl.addfile(info)
+			return info.linkname
+		# the caller adds what is inside a directory
+		if not os.path.isfile(path):
+			self.impl.add(path, arcname, recursive=False)
+			return None
+		info = self.impl.gettarinfo(path, arcname)
+		# a second name of an already packed file is stored in full,
+		# so that every member has the contents its Id was hashed from
+		if info.islnk():
+			info.type = tarfile.REGTYPE
+			info.linkname = ''
+			info.size = os.path.getsize(path)
+		with io.open(path, 'rb') as f:
+			self.impl.addfile(info, HashingReader(f, hash))
+		return None
 	def write(self, content, arcname):
 		with tempfile.TemporaryFile() as io:
 			io.write(content)
@@ -20,18 +155,55 @@ class Tar(Archive):
 			info.type = tarfile.REGTYPE
 			io.seek(0)
 			self.impl.addfile(info, io)
+	# regular members with a reader, symlinks with their target
+	def members(self):
+		for info in self.impl:
+			if info.isfile():
+				yield info.name, self.impl.extractfile(info), None
+			elif info.issym():
+				yield info.name, None, info.linkname
+	def files(self):
+		for name, f, link in self.members():
+			if link is None:
+				yield name, f
 	def read(self, arcname):
-		io = self.impl.extractfile(arcname)
+		try: io = self.impl.extractfile(arcname)
+		except KeyError: return None
 		if io is None: return None
 		try: return io.read()
 		finally: io.close()
 
 class Zip(Archive):
-	def __init__(self, path, mode = 'r'):
+	def __init__(self, path, mode = 'r', level = None):
 		Archive.__init__(self)
-		self.impl = zipfile.ZipFile(path, mode)
-	def add(self, path, arcname): self.impl.write(path, arcname)
+		if level is None:
+			self.impl = zipfile.ZipFile(path, mode)
+		else:
+			self.impl = zipfile.ZipFile(path, mode, zipfile.ZIP_DEFLATED, compresslevel=level)
+	# zip has no symlinks, they are stored as the file they point to
+	def add(self, path, arcname, hash = None):
+		if hash is None or not os.path.isfile(path):
+			self.impl.write(path, arcname)
+			return None
+		info = zipfile.ZipInfo.from_file(path, arcname)
+		info.compress_type = self.impl.compression
+		# ZipInfo.from_file leaves the level unset, which ZipFile.open
+		# then takes as zlib's default
+		if hasattr(zipfile.ZipInfo, 'compress_level'):
+			info.compress_level = self.impl.compresslevel
+		else:
+			info._compresslevel = self.impl.compresslevel
+		with io.open(path, 'rb') as src, self.impl.open(info, 'w') as dst:
+			shutil.copyfileobj(HashingReader(src, hash), dst, CHUNK_SIZE)
+		return None
 	def write(self, content, arcname): self.impl.writestr(arcname, content)
+	def members(self):
+		for name, f in self.files():
+			yield name, f, None
+	def files(self):
+		for info in self.impl.infolist():
+			if not info.filename.endswith('/'):
+				yield info.filename, self.impl.open(info)
 	def read(self, arcname):
 		try: return self.impl.read(arcname)
 		except: return None
@@ -39,10 +211,44 @@ class Zip(Archive):
 known_exts = [
 	(["tar.gz", "tgz"], "w:gz"),
 	(["tar.bz2", "tbz", "tbz2", "tb2"], "w:bz2"),
+	(["tar.xz", "txz"], "w:xz"),
 	(["zip"], "w")
 ]
 
-def open(name, mode = 'r'):
+def is_tar(name):
+	for exts, opts in known_exts:
+		if ':' not in opts: continue
+		for ext in exts:
+			if name.endswith('.' + ext):
+				return True
+	return False
+
+# upstream tarballs are unpacked before their checksum is known, so a
+# member must not land outside of dir; tarfile's 'data' filter checks the
+# resolved paths, older Pythons check each member as it comes
+def checked_members(tar, dir):
+	for info in tar:
+		dest = os.path.join(dir, *info.name.split('/'))
+		if not is_safe(info.name) or not is_inside(dir, os.path.dirname(dest)) or \
+				(info.issym() and not is_safe_link(info.name, info.linkname)) or \
+				(info.islnk() and not is_safe(info.linkname)):
+			raise tarfile.TarError('{0} points outside of {1}'.format(info.name, dir))
+		yield info
+
+def extract_tar(tar, dir):
+	if hasattr(tarfile, 'data_filter'):
+		tar.extractall(dir, filter='data')
+	else:
+		tar.extractall(dir, members=checked_members(tar, dir))
+
+def extract_stream(fileobj, dir):
+	with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+		extract_tar(tar, dir)
+	# consume the zero blocks and compression trailer after the last member
+	for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+		pass
+
+def open(name, mode = 'r', level = None, threads = 1):
 	if mode[:1] == 'r':
 		if tarfile.is_tarfile(name):
 			return Tar(name)
@@ -51,6 +257,7 @@ def open(name, mode = 'r'):
 		return None
 
 	if mode[:1] == 'w':
+		opts = None
 		for known_ext in known_exts:
 			for ext in known_ext[0]:
 				if name.endswith('.' + ext):
@@ -61,7 +268,7 @@ def open(name, mode = 'r'):
 		try: os.makedirs(os.path.dirname(name))
 		except: pass
 		if ':' in opts:
-			return Tar(name, opts)
-		return Zip(name, opts)
+			return Tar(name, opts, level, threads)
+		return Zip(name, opts, level)
 
 	return None
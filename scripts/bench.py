@@ -0,0 +1,191 @@
+import os, sys, time, random, hashlib, shutil, tempfile, argparse, archive, buildrepo, recipe
+
+benchmarks = []
+
+def benchmark(fn):
+	benchmarks.append(fn)
+	return fn
+
+def best_of(fn, repeat = 3):
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		fn()
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def report(out, name, size, elapsed, baseline = None):
+	line = '{0:<32} {1:>8} {2:>10.4f}s'.format(name, size, elapsed)
+	if baseline is not None:
+		line += ' {0:>10.4f}s {1:>8.1f}x'.format(baseline, baseline / max(elapsed, 1e-9))
+	out.write(line + '\n')
+
+def chain_repo(depth, broken = True):
+	repo = buildrepo.PlatformRepo()
+	for i in range(depth):
+		requires = ['pkg{}'.format(i - 1)] if i else []
+		if not i and broken: requires = ['missing']
+		repo.append(buildrepo.RepoPkg('posix/pkg{}.tar.gz'.format(i), {
+			'id': str(i), 'name': 'pkg{}'.format(i), 'version': '1.0', 'platform': 'POSIX',
+			'requires': requires, 'provides': ['pkg{}'.format(i)]
+		}))
+	repo.repopulate()
+	return repo
+
+def naive_minimize(repo):
+	# the pre-worklist behaviour: one level of pruning per pass,
+	# a list removal per package and a full repopulate between passes
+	while True:
+		missing = [(req, repo.requires[req]) for req in repo.requires if req not in repo.provides]
+		if not missing: return
+		for req, pkgs in missing:
+			for pkg in pkgs:
+				if pkg in repo.packages:
+					repo.packages.remove(pkg)
+		repo.repopulate()
+
+class NullOut:
+	def write(self, text): pass
+
+@benchmark
+def minimize(out):
+	for depth in [100, 1000, 2000, 4000]:
+		def fast():
+			repo = chain_repo(depth)
+			repo.minimize(NullOut())
+			assert not repo.packages
+		def slow():
+			repo = chain_repo(depth)
+			naive_minimize(repo)
+			assert not repo.packages
+		report(out, 'minimize/broken-chain', depth, best_of(fast), best_of(slow, 1))
+	for depth in [1000, 10000, 100000]:
+		def intact():
+			repo = chain_repo(depth, False)
+			repo.minimize(NullOut())
+			assert len(repo.packages) == depth
+		report(out, 'minimize/intact-chain', depth, best_of(intact))
+
+def check_linear(out, name, timings):
+	# doubling the input should roughly double the time; anything growing
+	# well past that between the smallest and the largest run is reported
+	(small, small_time), (large, large_time) = timings[0], timings[-1]
+	ratio = (large_time / max(small_time, 1e-9)) / (float(large) / small)
+	verdict = 'linear' if ratio < 2.5 else 'SUPERLINEAR'
+	out.write('{0:<32} {1:>8} {2:>10.2f}x {3}\n'.format(name, '', ratio, verdict))
+	return ratio < 2.5
+
+def continuation_recipe(count):
+	lines = ['Name: bench', 'Version: 1.0', 'Upstream: http://example.com/$name-$version.tar.gz', '%package "$name.tar.gz"', 'Pack: \\']
+	lines += ['  lib/file{0}.a \\'.format(i) for i in range(count)]
+	lines.append('  include/*')
+	return lines
+
+def expansion_value(count):
+	return ' '.join('$name/${{version}}/{0}'.format(i) for i in range(count))
+
+def manifest_text(count):
+	text = 'Id: 0\nName: bench\nVersion: 1.0\nPlatform: POSIX\n'
+	return text + ''.join('Provides: name{0}\nRequires: dep{0}\n'.format(i) for i in range(count))
+
+def scaling(out, name, sizes, make, run):
+	timings = []
+	for size in sizes:
+		data = make(size)
+		elapsed = best_of(lambda: run(data))
+		report(out, name, size, elapsed)
+		timings.append((size, elapsed))
+	return check_linear(out, name, timings)
+
+@benchmark
+def parser(out):
+	sizes = [5000, 10000, 20000, 40000]
+	def tokenize(lines):
+		tokens = recipe.Tokenizer()
+		for line in lines:
+			for tok in tokens.next_line(line): pass
+	ok = scaling(out, 'parser/next_line', sizes, continuation_recipe, tokenize)
+
+	def expand(value):
+		builder = recipe.RecipeBuilder('bench.conf')
+		builder.props['name'] = 'bench'
+		builder.props['version'] = '1.0'
+		builder.split(value)
+	ok &= scaling(out, 'parser/expand+split', sizes, expansion_value, expand)
+
+	ok &= scaling(out, 'parser/parse_manifset', sizes, manifest_text, recipe.parse_manifset)
+	return ok
+
+def payload(dir, size):
+	# half incompressible, half text-like, roughly what a mix of object
+	# code and headers looks like to the compressors
+	rng = random.Random(0)
+	words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz_') for _ in range(rng.randint(2, 12))) for _ in range(2000)]
+	paths = []
+	for i in range(8):
+		path = os.path.join(dir, 'file{}.bin'.format(i))
+		with open(path, 'wb') as f:
+			if i % 2:
+				f.write(os.urandom(size // 8))
+			else:
+				text = []
+				length = 0
+				while length < size // 8:
+					word = rng.choice(words)
+					text.append(word)
+					length += len(word) + 1
+				f.write(' '.join(text).encode('ascii'))
+		paths.append(path)
+	return paths
+
+@benchmark
+def pack(out):
+	dir = tempfile.mkdtemp()
+	try:
+		paths = payload(dir, 16 * 1024 * 1024)
+		threads = max(os.cpu_count() or 1, 4)
+		variants = [
+			('tar.gz', None, 1), ('tar.gz', 6, 1), ('tar.gz', 6, threads), ('tar.gz', 9, threads),
+			('tar.bz2', None, 1),
+			('tar.xz', None, 1), ('tar.xz', 6, threads), ('tar.xz', 3, threads),
+			('zip', None, 1), ('zip', 6, 1),
+		]
+		out.write('{0:<32} {1:>8} {2:>11} {3:>11}\n'.format('pack', 'threads', 'time', 'size'))
+		for ext, level, count in variants:
+			name = os.path.join(dir, 'out.' + ext)
+			def run():
+				arc = archive.open(name, 'w', level, count)
+				for path in paths:
+					arc.add(path, 'files/' + os.path.basename(path), hashlib.sha256())
+				arc.close()
+			elapsed = best_of(run, 1)
+			label = 'pack/{0} level={1}'.format(ext, 'default' if level is None else level)
+			out.write('{0:<32} {1:>8} {2:>10.4f}s {3:>11}\n'.format(label, count, elapsed, os.path.getsize(name)))
+			arc = archive.open(name)
+			assert arc is not None
+			arc.close()
+			os.remove(name)
+	finally:
+		shutil.rmtree(dir)
+
+def main():
+	names = [fn.__name__ for fn in benchmarks]
+	parser = argparse.ArgumentParser(description='Runs the tpm micro-benchmarks.')
+	parser.add_argument('names', nargs='*', metavar='name', help='benchmarks to run, one of: ' + ', '.join(names))
+	args = parser.parse_args()
+	for name in args.names:
+		if name not in names:
+			parser.error('unknown benchmark: {}'.format(name))
+
+	out = sys.stdout
+	out.write('{0:<32} {1:>8} {2:>11} {3:>11} {4:>9}\n'.format('benchmark', 'size', 'time', 'baseline', 'speedup'))
+	ok = True
+	for fn in benchmarks:
+		if args.names and fn.__name__ not in args.names: continue
+		if fn(out) is False: ok = False
+	if not ok: exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -1,129 +1,309 @@
-import os, sys, subprocess, glob, wget, archive, hashlib, recipe
+import os, sys, json, atexit, shutil, argparse, subprocess, glob, tarfile, archive, hashlib, recipe, dlcache, download, stamps, chunkstore, timing, jobserver, compilercache
+from urllib.error import URLError
+from http.client import HTTPException
 
-try:
-	result = recipe.parse_recipe(sys.argv[1])
-except SyntaxError as se:
-	sys.stderr.write(se.pretty())
-	sys.stderr.write('\n')
-	exit(1)
+class Tee:
+	def __init__(self, *hashes):
+		self.hashes = hashes
 
-def mkdir(path):
-	if os.path.exists(path): return
-	sys.stdout.write('+ mkdir -p {}\n'.format(path))
-	os.makedirs(path)
+	def update(self, data):
+		for hash in self.hashes:
+			hash.update(data)
 
-def rm(path):
-	if not os.path.exists(path): return
-	if os.path.isdir(path):
-		sys.stdout.write('+ rm -r {}\n'.format(path))
-		os.removedirs(path)
-		return
+# a Pack glob matching a directory packs everything below it, one member
+# at a time, so that every file goes into the package Id
+def walk(path):
+	yield path
+	if os.path.isdir(path) and not os.path.islink(path):
+		for name in sorted(os.listdir(path)):
+			for sub in walk(os.path.join(path, name)):
+				yield sub
 
-	sys.stdout.write('+ rm {}\n'.format(path))
-	os.remove(path)
+def state_key(*parts):
+	hash = hashlib.sha256()
+	for part in parts:
+		hash.update(u'{}\n'.format(part).encode('utf-8'))
+	return hash.hexdigest()
+
+def find_ccache(conf, err = sys.stderr):
+	launcher = compilercache.find(compilercache.default_launcher())
+	if launcher is None:
+		err.write('{0}: warning: compiler cache `{1}` not found, building without it\n'.format(conf, compilercache.default_launcher()))
+		return None
+	return compilercache.CompilerCache(launcher)
+
+# builds one parsed recipe from the current directory; nothing here
+# changes the working directory, so buildall.py --watch can run
+# several of them in its own process
+class Builder:
+	def __init__(self, conf, result, args, jobs, out = sys.stdout, err = sys.stderr):
+		self.conf = conf
+		self.result = result
+		self.args = args
+		self.jobs = jobs
+		self.out = out
+		self.err = err
+		self.ccache = find_ccache(conf, err) if args.ccache else None
+		self.stage = os.path.join('stage', result.props['dir'], os.path.basename(conf))
+		self.cwd = os.getcwd()
+		# what the stage directory was last prepared from; sources are reused
+		# while upstream stays the same, the build while its commands do too
+		self.state_path = os.path.join(os.path.abspath(self.stage), '.stage.json')
+
+	def path(self, path):
+		return os.path.join(self.cwd, path)
+
+	def mkdir(self, path):
+		if os.path.exists(self.path(path)): return
+		self.out.write('+ mkdir -p {}\n'.format(path))
+		os.makedirs(self.path(path))
+
+	def cd(self, path):
+		self.out.write('+ cd {}\n'.format(path))
+		self.cwd = os.path.abspath(self.path(path))
+
+	def load_state(self):
+		try:
+			with open(self.state_path) as f:
+				return json.load(f)
+		except (IOError, OSError, ValueError):
+			return {}
+
+	def save_state(self, state):
+		with open(self.state_path + '.tmp', 'w') as f:
+			json.dump(state, f, sort_keys=True)
+		os.replace(self.state_path + '.tmp', self.state_path)
+
+	def unpack(self, filename):
+		arc = archive.open(filename)
+		if arc is None:
+			self.err.write('{0}: do not know how to unpack {1}'.format(self.conf, filename))
+			return 1
+
+		if isinstance(arc, archive.Tar):
+			self.out.write('+ tar -x {}\n'.format(filename))
+		elif isinstance(arc, archive.Zip):
+			self.out.write('+ unzip {}\n'.format(filename))
+
+		try:
+			with timing.span('extract', archive=filename):
+				arc.extractall(self.path(self.result.props['sources']))
+		finally:
+			arc.close()
+		return 0
+
+	def fetch_sources(self):
+		cache = dlcache.DownloadCache()
+		upstream = self.result.props['upstream']
+		checksum = self.result.props.get('sha256')
+		mirrors = self.result.props.get('mirrors', [])
+		sources = self.path(self.result.props['sources'])
+		try:
+			filename = cache.lookup(upstream, checksum)
+			if filename is None and self.args.stream and archive.is_tar(upstream.split('?', 1)[0]):
+				try:
+					with timing.span('download+extract', url=upstream):
+						cache.stream_extract(upstream, checksum, sources, self.out, mirrors)
+				except:
+					self.out.write('+ rm -r {}\n'.format(self.result.props['sources']))
+					shutil.rmtree(sources, ignore_errors=True)
+					raise
+				return 0
+			with timing.span('download', url=upstream):
+				filename = cache.fetch(upstream, checksum, self.out, mirrors)
+			return self.unpack(filename)
+		except (dlcache.ChecksumError, download.DownloadError, URLError, HTTPException, tarfile.TarError) as e:
+			self.err.write('{0}: {1}\n'.format(self.conf, e))
+			return 1
+
+	def call(self, cmd):
+		cmd = [arg.replace(recipe.JOBS, str(self.jobs.tokens)) for arg in cmd]
+		if cmd[0] == recipe.CMAKE:
+			cmd = self.ccache.cmake(cmd[1:]) if self.ccache else ['cmake'] + cmd[1:]
+		cmd = [arg.replace(recipe.CMAKE, 'cmake') for arg in cmd]
+		self.out.write('++ {0}\n'.format(" ".join([recipe.escape(arg) for arg in cmd])))
+		if cmd[0] == 'cd':
+			if not os.path.isdir(self.path(cmd[1])):
+				self.out.write('{}: no such directory\n'.format(cmd[1]))
+				return 1
+			self.cwd = os.path.abspath(self.path(cmd[1]))
+			return 0
+		env = self.jobs.environ()
+		if self.ccache: env = self.ccache.environ(env)
+		self.out.flush()
+		return subprocess.call(cmd, cwd=self.cwd, env=env, pass_fds=self.jobs.pass_fds())
+
+	def build(self):
+		props = self.result.props
+		sources_key = state_key(props['upstream'], props.get('sha256', ''))
+		build_key = state_key(sources_key, *[' '.join(cmd) for cmd in self.result.build])
+		state = self.load_state() if self.args.incremental else {}
+		reuse_sources = state.get('sources') == sources_key and os.path.isdir(self.path(props['sources']))
+		if not reuse_sources:
+			self.save_state({})
+		if self.args.incremental and not reuse_sources:
+			for dir in (props['sources'], props['build_dir']):
+				if os.path.exists(self.path(dir)):
+					self.out.write('+ rm -r {}\n'.format(dir))
+					shutil.rmtree(self.path(dir))
+
+		self.mkdir(props['build_dir'])
+		self.mkdir(props['prefix'])
+		self.mkdir(props['sources'])
 
-def cd(path):
-	sys.stdout.write('+ cd {}\n'.format(path))
-	os.chdir(path)
+		if reuse_sources:
+			self.out.write('+ sources unchanged, reusing {}\n'.format(props['sources']))
+		else:
+			retval = self.fetch_sources()
+			if retval: return retval
+			self.save_state({'sources': sources_key})
 
-def bar_none(current, total, width=80): return ''
+		if reuse_sources and state.get('build') == build_key:
+			self.out.write('+ build unchanged, repacking\n')
+		else:
+			self.out.write('+ build recipe\n')
+			if self.ccache: self.ccache.start(self.path('ccache.log'))
+			for cmd in self.result.build:
+				with timing.span(' '.join(cmd)[:60], 'command', cmd=cmd):
+					retval = self.call(cmd)
+				if retval:
+					self.out.write('error in sub-process\n')
+					return retval
+			if self.ccache:
+				hits, misses = self.ccache.stats()
+				if hits + misses:
+					self.out.write('+ {0}: {1} hits, {2} misses, {3:.0f}% hit rate\n'.format(self.ccache.kind, hits, misses, 100.0 * hits / (hits + misses)))
 
-sys.stdout.write('=' * 80 + '\n')
+		self.save_state({'sources': sources_key, 'build': build_key})
+		return 0
+
+	def package_manifest(self, pkg, files, links):
+		props = self.result.props
+		manifest = u''
+		if 'name' in pkg.props:
+			manifest += u'Name: {}\n'.format(pkg.props['name'])
+		elif 'name' in props:
+			manifest += u'Name: {}\n'.format(props['name'])
+
+		if 'version' in pkg.props:
+			manifest += u'Version: {}\n'.format(pkg.props['version'])
+		elif 'version' in props:
+			manifest += u'Version: {}\n'.format(props['version'])
+
+		if 'dir' in props:
+			manifest += u'Platform: {}\n'.format(props['dir'].upper())
+
+		for name in pkg.provides:
+			manifest += u'Provides: {}\n'.format(recipe.escape(name))
 
-if 'upstream' not in result.props:
-	sys.stderr.write('{0}: `Upstream` url is missing from the recipe'.format(sys.argv[1]))
-	exit(1)
+		for name in pkg.requires:
+			manifest += u'Requires: {}\n'.format(recipe.escape(name))
 
-stage = os.path.join('stage', result.props['dir'], os.path.basename(sys.argv[1]))
+		for relpath, size, sha256 in files:
+			manifest += recipe.file_entry(relpath, size, sha256)
 
-root = os.getcwd()
-mkdir(stage)
-cd(stage)
+		for relpath, target in links:
+			manifest += recipe.link_entry(relpath, target)
+
+		return manifest
+
+	def pack(self, pkg, db, stamp):
+		pack_level = None
+		if 'TPM_PACK_LEVEL' in os.environ:
+			pack_level = int(os.environ['TPM_PACK_LEVEL'])
+		pack_threads = int(os.environ.get('TPM_PACK_THREADS', '1'))
+
+		name = os.path.join('packages', pkg.name)
+		self.out.write('+ packing {}\n'.format(name))
+		arc = archive.open(name, 'w', pack_level, pack_threads)
+		if arc is None:
+			self.out.write('{0}: do not know how to pack {1}'.format(self.conf, name))
+			return 1
 
-mkdir(result.props['build_dir'])
-mkdir(result.props['prefix'])
-mkdir(result.props['sources'])
+		base = os.path.join(self.stage, self.result.props['prefix'])
+		with timing.span('glob', package=pkg.name):
+			matches = [path for file in pkg.files for match in glob.glob(os.path.join(base, file)) for path in walk(match)]
+			# overlapping globs pack a path once
+			paths = list(dict.fromkeys(matches))
 
-sys.stdout.write('+ wget {}\n'.format(result.props['upstream']))
-filename = wget.download(result.props['upstream'], bar=bar_none)
+		hash = hashlib.sha256()
+		files = []
+		links = []
+		with timing.span('pack', package=pkg.name):
+			for path in paths:
+				relpath = os.path.relpath(path, base).replace('\\', '/')
+				file_hash = hashlib.sha256()
+				link = arc.add(path, 'files/' + relpath, Tee(hash, file_hash))
+				if link is not None:
+					links.append((relpath, link))
+				elif os.path.isfile(path):
+					files.append((relpath, os.path.getsize(path), file_hash.hexdigest()))
 
-arc = archive.open(filename)
-if arc is None:
-	sys.stderr.write('{0}: do not know how to unpack {1}'.format(sys.argv[1], filename))
-	exit(1)
+		with timing.span('manifest', package=pkg.name):
+			manifest = self.package_manifest(pkg, files, links)
+			hash.update(manifest.encode('utf-8'))
+			manifest = u'Id: {}\n'.format(hash.hexdigest()) + manifest
 
-if isinstance(arc, archive.Tar):
-	sys.stdout.write('+ tar -x {}\n'.format(filename))
-elif isinstance(arc, archive.Zip):
-	sys.stdout.write('+ unzip {}\n'.format(filename))
+		with timing.span('pack', package=pkg.name):
+			arc.write(manifest.encode('utf-8'), 'MANIFEST')
+			arc.close()
 
+		if self.args.chunked:
+			self.out.write('+ chunking {}\n'.format(name))
+			with timing.span('chunk', package=pkg.name):
+				chunkstore.import_archive(name, chunkstore.ChunkStore(os.path.join('packages', chunkstore.STORE)))
+			os.remove(name)
 
-try:
-	arc.extractall(result.props['sources'])
-finally:
-	arc.close()
+		db.put(pkg.name, {'stamp': stamp, 'id': hash.hexdigest(), 'recipe': self.conf, 'provides': pkg.provides, 'file': stamps.package_stat(name)})
+		return 0
 
-rm(filename)
+	def run(self):
+		self.out.write('=' * 80 + '\n')
 
-def call(cmd):
-	sys.stdout.write('++ {0}\n'.format(" ".join([recipe.escape(arg) for arg in cmd])))
-	if cmd[0] == 'cd':
-		try: os.chdir(cmd[1])
-		except Exception as e:
-			print (e)
+		if 'upstream' not in self.result.props:
+			self.err.write('{0}: `Upstream` url is missing from the recipe'.format(self.conf))
 			return 1
+
+		db = stamps.StampDB()
+		stamp = stamps.recipe_stamp(self.conf, self.result, stamps.requirement_ids(self.conf, self.result, db.providers()))
+
+		root = os.getcwd()
+		self.mkdir(self.stage)
+		self.cd(self.stage)
+		retval = self.build()
+		if retval: return retval
+		self.cd(root)
+
+		for pkg in self.result.packages:
+			retval = self.pack(pkg, db, stamp)
+			if retval: return retval
 		return 0
-	return subprocess.call(cmd)
-
-sys.stdout.write('+ build recipe\n')
-for cmd in result.build:
-	retval = call(cmd)
-	if retval:
-		sys.stdout.write('error in sub-process\n')
-		exit(retval)
-
-cd(root)
-
-for pkg in result.packages:
-	name = os.path.join('packages', pkg.name)
-	sys.stdout.write('+ packing {}\n'.format(name))
-	arc = archive.open(name, 'w')
-	if arc is None:
-		sys.stdout.write('{0}: do not know how to pack {1}'.format(sys.argv[1], name))
+
+def main():
+	parser = argparse.ArgumentParser(description='Builds and packs a single recipe.')
+	parser.add_argument('recipe', help='path to the recipe')
+	parser.add_argument('--stream', action='store_true', help='extract tar sources while they download, without keeping the archive')
+	parser.add_argument('--incremental', action='store_true', help='reuse sources and build directory of the previous build of this recipe')
+	parser.add_argument('--chunked', action='store_true', help='store packages as chunk lists in packages/' + chunkstore.STORE)
+	parser.add_argument('--trace', metavar='FILE', help='write a Chrome trace of the build phases to FILE')
+	parser.add_argument('--cores', type=int, default=jobserver.default_cores(), help='number of processes the build commands may run at once, unless started by buildall.py or make')
+	parser.add_argument('--ccache', action='store_true', help='compile through ccache or sccache, see TPM_CCACHE')
+	args = parser.parse_args()
+	conf = args.recipe
+	jobs = jobserver.JobServer.from_environ() or jobserver.JobServer(args.cores)
+
+	if args.trace and timing.start(args.trace):
+		atexit.register(timing.finish)
+
+	try:
+		result = recipe.parse_recipe(conf, dlcache.recipe_cache())
+	except SyntaxError as se:
+		sys.stderr.write(se.pretty())
+		sys.stderr.write('\n')
 		exit(1)
 
-	hash = hashlib.sha256()
-	base = os.path.join(stage, result.props['prefix'])
-	for file in pkg.files:
-		match = os.path.join(base, file)
-		for path in glob.iglob(match):
-			dest = os.path.join('files', os.path.relpath(path, base)).replace('\\', '/')
-			arc.add(path, dest)
-			with open(path, 'rb') as f:
-				hash.update(f.read())
-
-	manifest = u''
-	if 'name' in pkg.props:
-		manifest += u'Name: {}\n'.format(pkg.props['name'])
-	elif 'name' in result.props:
-		manifest += u'Name: {}\n'.format(result.props['name'])
-
-	if 'version' in pkg.props:
-		manifest += u'Version: {}\n'.format(pkg.props['version'])
-	elif 'version' in result.props:
-		manifest += u'Version: {}\n'.format(result.props['version'])
-
-	if 'dir' in result.props:
-		manifest += u'Platform: {}\n'.format(result.props['dir'].upper())
-
-	for name in pkg.provides:
-		manifest += u'Provides: {}\n'.format(recipe.escape(name))
-
-	for name in pkg.requires:
-		manifest += u'Requires: {}\n'.format(recipe.escape(name))
-
-	hash.update(manifest.encode('utf-8'))
-	manifest = u'Id: {}\n'.format(hash.hexdigest()) + manifest
-
-	arc.write(manifest.encode('utf-8'), 'MANIFEST')
-	arc.close()
+	retval = Builder(conf, result, args, jobs).run()
+	if retval: exit(retval)
+
+if __name__ == '__main__':
+	main()
@@ -1,45 +1,185 @@
-import os, sys, recipe
-from subprocess import check_call
+import os, sys, atexit, argparse, recipe, depgraph, dlcache, stamps, chunkstore, distbuild, timing, jobserver, watcher, buildrepo
+import build as builder
+from subprocess import call
+
+parser = argparse.ArgumentParser(description='Builds all out-of-date recipes.')
+parser.add_argument('-j', '--jobs', type=depgraph.positive_int, default=1, help='number of recipes to build concurrently')
+parser.add_argument('--cores', type=depgraph.positive_int, default=jobserver.default_cores(), help='number of processes all concurrent builds may run together')
+parser.add_argument('--stream', action='store_true', help='extract tar sources while they download, see build.py --stream')
+parser.add_argument('--incremental', action='store_true', help='reuse stage directories of earlier builds, see build.py --incremental')
+parser.add_argument('--ccache', action='store_true', help='compile through a shared compiler cache, see build.py --ccache')
+parser.add_argument('--chunked', action='store_true', help='store packages as chunk lists, see build.py --chunked')
+parser.add_argument('--listen', metavar='[HOST:]PORT', help='hand recipes out to workers connecting to this address, see distbuild.py')
+parser.add_argument('--trace', metavar='FILE', help='write a Chrome trace of all recipes and their build phases to FILE')
+parser.add_argument('--watch', action='store_true', help='keep running, rebuilding recipes and repo.xml as recipes/ and packages/ change')
+args = parser.parse_args()
+
+if args.trace and timing.start(args.trace):
+	atexit.register(timing.finish)
 
 pkgs = {}
-for root, dir, files in os.walk('recipes'):
-	for filename in files:
-		pkgs[os.path.join(root, filename)] = []
-
-remove = []
-for conf in pkgs:
-	try: result = recipe.parse_recipe(conf)
-	except recipe.SyntaxError as se:
-		sys.stderr.write(se.pretty())
-		sys.stderr.write('\n')
-		remove.append(conf)
-		continue
-	except:
-		remove.append(conf)
-		continue
-	pkgs[conf] = [os.path.join('packages', pkg.name) for pkg in result.packages]
-
-for conf in remove:
-	del pkgs[conf]
-
-def mtime(path):
-	if not os.path.exists(path): return 0
-	return os.stat(path).st_mtime
-
-confs = []
-for conf in sorted(pkgs):
-	needs_update = False
-	lhs = mtime(conf)
-	for pkg in pkgs[conf]:
-		rhs = mtime(pkg)
-		if rhs < lhs:
-			needs_update = True
-			break
-	if needs_update:
-		confs.append(conf)
-
-for conf in confs:
+recipes = {}
+
+def all_recipes():
+	confs = []
+	for root, dir, files in os.walk('recipes'):
+		for filename in files:
+			confs.append(os.path.join(root, filename))
+	return confs
+
+def load_recipes(confs):
+	for conf in confs:
+		pkgs.pop(conf, None)
+		recipes.pop(conf, None)
+		if not os.path.isfile(conf): continue
+		try: result = recipe.parse_recipe(conf, dlcache.recipe_cache())
+		except recipe.SyntaxError as se:
+			sys.stderr.write(se.pretty())
+			sys.stderr.write('\n')
+			continue
+		except:
+			continue
+		recipes[conf] = result
+		pkgs[conf] = [os.path.join('packages', pkg.name) for pkg in result.packages]
+	# parsing stores new recipe pickles in the download cache
+	cache.evict()
+
+db = stamps.StampDB()
+
+def is_current(conf, providers):
+	result = recipes[conf]
+	stamp = stamps.recipe_stamp(conf, result, stamps.requirement_ids(conf, result, providers))
+	for pkg in result.packages:
+		if not stamps.is_current(db, pkg.name, stamp):
+			return False
+	return True
+
+cache = dlcache.DownloadCache()
+coordinator = None
+if args.listen:
+	coordinator = distbuild.Coordinator(distbuild.parse_address(args.listen), sys.stderr)
+
+# every build.py runs on a token of its own, and its build commands
+# share the rest of the pool through MAKEFLAGS
+jobs = jobserver.JobServer.from_environ() or jobserver.JobServer(args.cores, 0)
+
+def run(cmd):
+	token = jobs.acquire()
+	try: return call(cmd, env=jobs.environ(), pass_fds=jobs.pass_fds())
+	finally: jobs.release(token)
+
+# the daemon builds in its own process, saving an interpreter start
+# and a recipe parse per build
+def run_builder(conf):
+	token = jobs.acquire()
+	try: return builder.Builder(conf, recipes[conf], args, jobs).run()
+	except Exception as e:
+		sys.stderr.write('{0}: {1}\n'.format(conf, e))
+		return 1
+	finally: jobs.release(token)
+
+# workers send back plain archives; stamps and the chunk store
+# are kept by the coordinator
+def remote_build(conf):
+	result = recipes[conf]
+	with open(conf, 'rb') as f:
+		text = f.read()
+	flags = []
+	if args.stream: flags.append('--stream')
+	if args.incremental: flags.append('--incremental')
+	if args.ccache: flags.append('--ccache')
+	retval = coordinator.build(conf, text, [pkg.name for pkg in result.packages], flags)
+	if retval: return retval
+	stamp = stamps.recipe_stamp(conf, result, stamps.requirement_ids(conf, result, db.providers()))
+	for pkg in result.packages:
+		path = os.path.join('packages', pkg.name)
+		if args.chunked:
+			sys.stderr.write('+ chunking {}\n'.format(path))
+			chunkstore.import_archive(path, chunkstore.ChunkStore(os.path.join('packages', chunkstore.STORE)))
+			os.remove(path)
+		db.put(pkg.name, {'stamp': stamp, 'id': stamps.package_id(path), 'recipe': conf, 'provides': pkg.provides, 'file': stamps.package_stat(path)})
+	return 0
+
+pending = set()
+
+def build(conf):
+	if conf in pending and is_current(conf, db.providers()):
+		return 0
+	with timing.span(conf, 'recipe'):
+		return build_recipe(conf)
+
+def build_recipe(conf):
 	for pkg in pkgs[conf]:
 		sys.stderr.write('{}\n'.format(pkg))
-	result = check_call(['python', 'scripts/build.py', conf])
-	if result: exit(result)
+	if coordinator is not None:
+		return remote_build(conf)
+	if args.watch:
+		return run_builder(conf)
+	cmd = ['python', 'scripts/build.py']
+	if args.chunked: cmd.append('--chunked')
+	if args.incremental: cmd.append('--incremental')
+	if args.ccache: cmd.append('--ccache')
+	if args.stream:
+		return run(cmd + ['--stream', conf])
+	# sources of an incremental build may not be needed at all
+	if args.incremental:
+		return run(cmd + [conf])
+	props = recipes[conf].props
+	if 'upstream' in props:
+		try: cache.fetch(props['upstream'], props.get('sha256'), sys.stderr, props.get('mirrors', []))
+		except Exception as e:
+			sys.stderr.write('{0}: {1}\n'.format(conf, e))
+			return 1
+	return run(cmd + [conf])
+
+def build_outdated():
+	graph = depgraph.DepGraph(recipes)
+	if not graph.report(sys.stderr):
+		return 1
+
+	# recipes depending on something that gets rebuilt are scheduled as well,
+	# but are only built if the rebuilt dependency actually changed its Id
+	providers = db.providers()
+	dirty = set()
+	pending.clear()
+	for conf in graph.order():
+		if graph.deps[conf] & (dirty | pending):
+			pending.add(conf)
+		elif not is_current(conf, providers):
+			dirty.add(conf)
+
+	return graph.schedule(sorted(dirty | pending), args.jobs, build)
+
+# files the daemon writes itself, or which are still being written
+def ignored(path):
+	name = os.path.basename(path)
+	return name.startswith('.') or name in buildrepo.INDEX_FILES or name in ('index.xml', 'repo.db') \
+		or name.endswith('.part') or name.endswith('.tmp')
+
+def watch():
+	for dir in ('recipes', 'packages'):
+		try: os.makedirs(dir)
+		except OSError: pass
+	index = buildrepo.ManifestCache(os.path.join('packages', '.manifests.json'))
+	changes = watcher.create(['recipes', 'packages'], ignored)
+	sys.stderr.write('+ watching recipes/ and packages/ ({})\n'.format(type(changes).__name__))
+	while True:
+		build_outdated()
+		if buildrepo.refresh('packages', index, out=sys.stderr):
+			sys.stderr.write('+ packages/repo.xml\n')
+		changed = changes.wait()
+		confs = sorted(path for path in changed if path.startswith('recipes' + os.sep) and (path in recipes or os.path.exists(path)))
+		for conf in confs:
+			sys.stderr.write('+ changed {}\n'.format(conf))
+		load_recipes(confs)
+
+load_recipes(all_recipes())
+if args.watch:
+	try: watch()
+	except KeyboardInterrupt: pass
+	result = 0
+else:
+	result = build_outdated()
+if coordinator is not None:
+	coordinator.close()
+if result: exit(result)
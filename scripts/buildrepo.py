@@ -1,4 +1,5 @@
-import os, sys, archive, recipe
+import os, sys, io, json, atexit, hashlib, sqlite3, argparse, archive, recipe, chunkstore, delta, timing
+from concurrent.futures import ProcessPoolExecutor
 from xml.sax.saxutils import escape
 
 class RepoPkg:
@@ -10,6 +11,9 @@ class RepoPkg:
 		self.platform = props['platform']
 		self.requires = props['requires']
 		self.provides = props['provides']
+		self.files = props.get('files', [])
+		self.links = props.get('links', [])
+		self.deltas = props.get('deltas', [])
 
 	def xml(self, out):
 		out.write('  <package\n')
@@ -22,6 +26,8 @@ class RepoPkg:
 			out.write('    <provides name="{}"/>\n'.format(escape(name)))
 		for name in self.requires:
 			out.write('    <requires name="{}"/>\n'.format(escape(name)))
+		for item in self.deltas:
+			out.write('    <delta from="{0}" pkg="{1}" size="{2}"/>\n'.format(escape(item['from']), escape(item['pkg']), item['size']))
 		out.write('  </package>\n')
 
 class PlatformRepo:
@@ -29,6 +35,8 @@ class PlatformRepo:
 		self.packages = []
 		self.provides = {}
 		self.requires = {}
+		self.removed = []
+		self.reasons = {}
 
 	def append(self, pkg):
 		self.packages.append(pkg)
@@ -47,19 +55,61 @@ class PlatformRepo:
 					self.requires[name] = []
 				self.requires[name].append(pkg)
 
-	def minimize(self):
-		for req in self.requires:
-			if req in self.provides:
-				del self.requires[req]
-		if not len(self.requires):
-			return True
-		for req in self.requires:
-			missing = self.requires[req]
-			for pkg in missing:
-				sys.stdout.write('%s: warning: repo cannot supply package for \'%s\' requirement\n' % (pkg.uri, req))
-				self.packages.remove(pkg)
+	def minimize(self, out = sys.stdout):
+		live = {}
+		for name in self.provides:
+			live[name] = len(self.provides[name])
+
+		reasons = {}
+		worklist = []
+		def drop(pkg, req, cause):
+			if id(pkg) in reasons: return
+			reasons[id(pkg)] = (req, cause)
+			worklist.append(pkg)
+
+		for pkg in self.packages:
+			for req in pkg.requires:
+				if req not in live:
+					drop(pkg, req, None)
+					break
+
+		index = 0
+		while index < len(worklist):
+			pkg = worklist[index]
+			index += 1
+			for name in pkg.provides:
+				live[name] -= 1
+				if live[name]: continue
+				if name not in self.requires: continue
+				for dep in self.requires[name]:
+					drop(dep, name, pkg)
+
+		self.removed = []
+		self.reasons = reasons
+		for pkg in worklist:
+			req, cause = reasons[id(pkg)]
+			self.removed.append((pkg, req, cause))
+			out.write('%s: warning: repo cannot supply package for \'%s\' requirement\n' % (pkg.uri, req))
+			# every provider on the way down to the requirement nothing supplies
+			steps = self.chain(pkg)
+			for (dep, provided), (cause, req) in zip(steps, steps[1:]):
+				out.write('%s: note: \'%s\' provided here, but removed for \'%s\' requirement\n' % (cause.uri, provided, req))
+
+		if len(worklist):
+			self.packages = [pkg for pkg in self.packages if id(pkg) not in reasons]
+			self.repopulate()
 		return True
 
+	# the removed package and its requirement, followed by the providers
+	# removed before it, ending with the one whose requirement is missing
+	def chain(self, pkg):
+		result = []
+		while pkg is not None:
+			req, cause = self.reasons[id(pkg)]
+			result.append((pkg, req))
+			pkg = cause
+		return result
+
 class Repo:
 	def __init__(self):
 		self.platforms = {}
@@ -84,49 +134,125 @@ class Repo:
 			del self.platforms[platform]
 		return result
 
-platforms = []
-base = 'packages'
-repo = Repo()
+class ManifestCache:
+	def __init__(self, path):
+		self.path = path
+		self.entries = {}
+		self.seen = set()
+		self.dirty = False
+		try:
+			with open(path) as f:
+				self.entries = json.load(f)
+		except (IOError, OSError, ValueError):
+			pass
 
-for root, dirs, files in os.walk(base):
-	platforms = [os.path.join(root, dir) for dir in dirs]
-	break
+	def stamp(self, path):
+		try: st = os.stat(path)
+		except OSError: return None
+		return [st.st_size, st.st_mtime]
 
-packages = []
-for platform in platforms:
-	for root, dirs, files in os.walk(platform):
-		packages += [os.path.join(root, file) for file in files]
-		break
+	def get(self, key, path):
+		self.seen.add(key)
+		entry = self.entries.get(key)
+		if entry is None or entry['stamp'] != self.stamp(path):
+			return None
+		return entry
+
+	def put(self, key, path, manifest):
+		self.seen.add(key)
+		entry = {'stamp': self.stamp(path), 'manifest': manifest}
+		self.entries[key] = entry
+		self.dirty = True
+		return entry
+
+	def save(self):
+		for key in list(self.entries):
+			if key not in self.seen:
+				del self.entries[key]
+				self.dirty = True
+		self.seen = set()
+		if not self.dirty: return
+		tmp = self.path + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump(self.entries, f, sort_keys=True)
+		os.replace(tmp, self.path)
+		self.dirty = False
 
-for pkg in packages:
-	arc = archive.open(pkg)
-	if arc is None: continue
+# a corrupt archive, or one still being copied into packages/, is
+# reported instead of stopping the whole run; its None is cached until
+# the file changes again
+def read_manifest(path):
+	with timing.span(os.path.basename(path), 'archive', path=path):
+		try: return read_archive_manifest(path), None
+		except Exception as e:
+			return None, '{0}: warning: cannot read the package, skipping: {1}\n'.format(path, e or type(e).__name__)
+
+def read_archive_manifest(path):
+	if chunkstore.is_chunked(path):
+		return recipe.parse_manifset(chunkstore.read_manifest(path))
+	arc = archive.open(path)
+	if arc is None: return None
 	try:
 		manifest = arc.read('MANIFEST')
-		if manifest is None: continue
-		manifest = 	recipe.parse_manifset(manifest)
+		if manifest is None: return None
+		if isinstance(manifest, bytes):
+			manifest = manifest.decode('utf-8')
+		return recipe.parse_manifset(manifest)
 	finally: arc.close()
 
-	pkg = RepoPkg(os.path.relpath(pkg, base), manifest)
-	repo.append(pkg)
+INDEX_FILES = ['repo.xml']
+
+def scan(base):
+	platforms = []
+	for root, dirs, files in os.walk(base):
+		platforms = [os.path.join(root, dir) for dir in dirs if not dir.startswith('.')]
+		break
+
+	packages = []
+	for platform in platforms:
+		for root, dirs, files in os.walk(platform):
+			packages += [os.path.join(root, file) for file in files if file not in INDEX_FILES]
+			break
+	return sorted(packages)
+
+def read_manifests(packages, jobs):
+	if jobs < 2 or len(packages) < 2:
+		return [read_manifest(pkg) for pkg in packages]
+	with ProcessPoolExecutor(max_workers=jobs) as pool:
+		return list(pool.map(read_manifest, packages, chunksize=16))
+
+def load(base, packages, cache, jobs = 1, out = sys.stdout):
+	repo = Repo()
+	keys = [os.path.relpath(pkg, base).replace('\\', '/') for pkg in packages]
+	entries = [cache.get(key, pkg) for key, pkg in zip(keys, packages)]
+	missing = [pkg for pkg, entry in zip(packages, entries) if entry is None]
+	manifests = iter(read_manifests(missing, jobs))
+	for key, pkg, entry in zip(keys, packages, entries):
+		if entry is None:
+			manifest, error = next(manifests)
+			if error is not None: out.write(error)
+			entry = cache.put(key, pkg, manifest)
+		manifest = entry['manifest']
+		if manifest is None: continue
 
-repo.repopulate()
-while not repo.minimize():
-	repo.repopulate()
+		repo.append(RepoPkg(os.path.relpath(pkg, base), manifest))
+	return repo
 
-reorg = {}
-for platform in repo.platforms:
-	p = repo.platforms[platform]
-	for pkg in p.packages:
-		key = (pkg.name, pkg.version)
-		if key not in reorg:
-			reorg[key] = {}
-		reorg[key][pkg.uri] = pkg
+def flatten(repo):
+	reorg = {}
+	for platform in repo.platforms:
+		p = repo.platforms[platform]
+		for pkg in p.packages:
+			key = (pkg.name, pkg.version)
+			if key not in reorg:
+				reorg[key] = {}
+			reorg[key][pkg.uri] = pkg
 
-repo = []
-for key in sorted(reorg):
-	for uri in sorted(reorg[key]):
-		repo.append(reorg[key][uri])
+	result = []
+	for key in sorted(reorg):
+		for uri in sorted(reorg[key]):
+			result.append(reorg[key][uri])
+	return result
 
 def xml(repo, out):
 	out.write('<?xml version="1.0" encoding="utf-8"?>\n<repo>\n')
@@ -134,9 +260,145 @@ def xml(repo, out):
 		pkg.xml(out)
 	out.write('</repo>\n')
 
-# in case there are no no packages yet:
-try: os.mkdir('packages')
-except: pass
+# bump with every change to SCHEMA, so an existing repo.db is rebuilt
+SCHEMA_VERSION = 2
+SCHEMA = '''
+CREATE TABLE packages (
+	rowid INTEGER PRIMARY KEY,
+	id TEXT NOT NULL,
+	pkg TEXT NOT NULL,
+	name TEXT NOT NULL,
+	version TEXT NOT NULL,
+	platform TEXT NOT NULL
+);
+CREATE TABLE provides (name TEXT NOT NULL, package INTEGER NOT NULL REFERENCES packages(rowid));
+CREATE TABLE requires (name TEXT NOT NULL, package INTEGER NOT NULL REFERENCES packages(rowid));
+CREATE TABLE deltas (package INTEGER NOT NULL REFERENCES packages(rowid), from_id TEXT NOT NULL, pkg TEXT NOT NULL, size INTEGER NOT NULL);
+CREATE INDEX packages_lookup ON packages (name, version, platform);
+CREATE INDEX provides_lookup ON provides (name, package);
+CREATE INDEX requires_lookup ON requires (package);
+CREATE INDEX deltas_lookup ON deltas (package, from_id);
+'''
+
+def sqlite(repo, path):
+	tmp = path + '.tmp'
+	if os.path.exists(tmp): os.remove(tmp)
+	db = sqlite3.connect(tmp)
+	try:
+		db.executescript(SCHEMA)
+		db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+		for rowid, pkg in enumerate(repo, 1):
+			db.execute('INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?)',
+				(rowid, pkg.id, pkg.uri, pkg.name, pkg.version, pkg.platform))
+			db.executemany('INSERT INTO provides VALUES (?, ?)', [(name, rowid) for name in pkg.provides])
+			db.executemany('INSERT INTO requires VALUES (?, ?)', [(name, rowid) for name in pkg.requires])
+			db.executemany('INSERT INTO deltas VALUES (?, ?, ?, ?)', [(rowid, item['from'], item['pkg'], item['size']) for item in pkg.deltas])
+		db.commit()
+	finally:
+		db.close()
+	os.replace(tmp, path)
+
+def schema_version(path):
+	if not os.path.exists(path): return None
+	try:
+		db = sqlite3.connect(path)
+		try: return db.execute('PRAGMA user_version').fetchone()[0]
+		finally: db.close()
+	except sqlite3.DatabaseError:
+		return None
+
+def render(repo):
+	out = io.StringIO()
+	xml(repo, out)
+	return out.getvalue().encode('utf-8')
+
+def update(path, data):
+	digest = hashlib.sha256(data).hexdigest()
+	try:
+		with open(path, 'rb') as f:
+			if f.read() == data: return digest, False
+	except (IOError, OSError):
+		pass
+	tmp = path + '.tmp'
+	with open(tmp, 'wb') as f:
+		f.write(data)
+	os.replace(tmp, path)
+	return digest, True
+
+def shard_dir(platform):
+	return platform.lower()
+
+def write_shards(base, repo, out = sys.stdout):
+	shards = {}
+	for pkg in repo:
+		if pkg.platform not in shards:
+			shards[pkg.platform] = []
+		shards[pkg.platform].append(pkg)
+
+	index = u'<?xml version="1.0" encoding="utf-8"?>\n<index>\n'
+	for platform in sorted(shards):
+		href = '{}/repo.xml'.format(shard_dir(platform))
+		path = os.path.join(base, shard_dir(platform), 'repo.xml')
+		digest, changed = update(path, render(shards[platform]))
+		if changed:
+			out.write('+ {}\n'.format(path))
+		index += u'  <shard platform="{0}" href="{1}" sha256="{2}" packages="{3}"/>\n'.format(
+			escape(platform), escape(href), digest, len(shards[platform]))
+	index += u'</index>\n'
+
+	for root, dirs, files in os.walk(base):
+		for dir in dirs:
+			if dir.upper() in shards: continue
+			stale = os.path.join(root, dir, 'repo.xml')
+			if os.path.exists(stale):
+				out.write('+ rm {}\n'.format(stale))
+				os.remove(stale)
+		break
+
+	return update(os.path.join(base, 'index.xml'), index.encode('utf-8'))
+
+# the cache may be kept between calls, as buildall.py --watch does, so
+# only archives changed since the previous call are opened
+def refresh(base, cache, jobs = 1, deltas = False, out = sys.stdout):
+	with timing.span('scan'):
+		packages = scan(base)
+
+	# in case there are no no packages yet:
+	try: os.mkdir(base)
+	except: pass
+
+	with timing.span('load'):
+		repo = load(base, packages, cache, jobs, out)
+		cache.save()
+
+	with timing.span('minimize'):
+		repo.repopulate()
+		while not repo.minimize():
+			repo.repopulate()
+
+	repo = flatten(repo)
+	with timing.span('deltas'):
+		delta.update_deltas(base, repo, chunkstore.ChunkStore(os.path.join(base, chunkstore.STORE)), deltas, out)
+	with timing.span('index'):
+		write_shards(base, repo, out)
+		db = os.path.join(base, 'repo.db')
+		digest, changed = update(os.path.join(base, 'repo.xml'), render(repo))
+		if changed or schema_version(db) != SCHEMA_VERSION:
+			sqlite(repo, db)
+	return changed
+
+def main():
+	parser = argparse.ArgumentParser(description='Rebuilds packages/repo.xml from the archives in packages/<platform>.')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes reading archives')
+	parser.add_argument('--deltas', action='store_true', help='generate binary deltas between consecutive versions of a package')
+	parser.add_argument('--trace', metavar='FILE', help='write a Chrome trace of reading the archives to FILE')
+	args = parser.parse_args()
+
+	if args.trace and timing.start(args.trace):
+		atexit.register(timing.finish)
+
+	base = 'packages'
+	refresh(base, ManifestCache(os.path.join(base, '.manifests.json')), args.jobs, args.deltas)
 
-with open('packages/repo.xml', 'w') as out:
-	xml(repo, out)
\ No newline at end of file
+if __name__ == '__main__':
+	main()
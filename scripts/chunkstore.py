@@ -0,0 +1,223 @@
+import os, sys, json, zlib, hashlib, argparse, archive
+
+CHUNK_SIZE = 128 * 1024
+EXT = '.chunks'
+STORE = '.chunks'
+
+class ChunkError(Exception):
+	pass
+
+def chunk_uri(hash):
+	return '{0}/{1}/{2}'.format(STORE, hash[:2], hash)
+
+class ChunkStore:
+	def __init__(self, root):
+		self.root = root
+
+	def path(self, hash):
+		return os.path.join(self.root, hash[:2], hash)
+
+	def has(self, hash):
+		return os.path.exists(self.path(hash))
+
+	def write(self, hash, blob):
+		path = self.path(hash)
+		if os.path.exists(path): return
+		try: os.makedirs(os.path.dirname(path))
+		except OSError: pass
+		tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+		with open(tmp, 'wb') as f:
+			f.write(blob)
+		os.replace(tmp, path)
+
+	def put(self, data):
+		hash = hashlib.sha256(data).hexdigest()
+		if not self.has(hash):
+			self.write(hash, zlib.compress(data, 9))
+		return hash
+
+	def put_compressed(self, hash, blob):
+		if hashlib.sha256(zlib.decompress(blob)).hexdigest() != hash:
+			raise ChunkError('chunk {} does not match its contents'.format(hash))
+		self.write(hash, blob)
+
+	def get(self, hash):
+		try:
+			with open(self.path(hash), 'rb') as f:
+				return zlib.decompress(f.read())
+		except (IOError, OSError):
+			raise ChunkError('chunk {} missing from {}'.format(hash, self.root))
+
+	def chunks(self):
+		for root, dirs, files in os.walk(self.root):
+			for filename in files:
+				if not filename.endswith('.tmp'):
+					yield filename, os.path.join(root, filename)
+
+	def gc(self, live):
+		count, size = 0, 0
+		for hash, path in list(self.chunks()):
+			if hash in live: continue
+			size += os.path.getsize(path)
+			os.remove(path)
+			count += 1
+		for root, dirs, files in os.walk(self.root, topdown=False):
+			if root != self.root and not os.listdir(root):
+				os.rmdir(root)
+		return count, size
+
+class ChunkReader:
+	def __init__(self, store, chunks):
+		self.store = store
+		self.chunks = list(chunks)
+		self.data = b''
+
+	def read(self, size = -1):
+		while self.chunks and (size < 0 or len(self.data) < size):
+			self.data += self.store.get(self.chunks.pop(0))
+		if size < 0: size = len(self.data)
+		result, self.data = self.data[:size], self.data[size:]
+		return result
+
+	def close(self):
+		self.chunks = []
+		self.data = b''
+
+class ChunkedPackage:
+	def __init__(self, path, store):
+		self.store = store
+		with open(path) as f:
+			self.index = json.load(f)
+
+	def members(self):
+		for entry in self.index['files']:
+			if 'link' in entry:
+				yield entry['path'], None, entry['link']
+			else:
+				yield entry['path'], ChunkReader(self.store, entry['chunks']), None
+
+	def files(self):
+		for name, f, link in self.members():
+			if link is None:
+				yield name, f
+
+	def extractall(self, dir):
+		for name, f, link in self.members():
+			if not archive.is_safe(name) or (link is not None and not archive.is_safe_link(name, link)):
+				raise ChunkError('{0} points outside of {1}'.format(name, dir))
+			dest = os.path.join(dir, *name.split('/'))
+			if not archive.is_inside(dir, os.path.dirname(dest)):
+				raise ChunkError('{0} points outside of {1}'.format(name, dir))
+			try: os.makedirs(os.path.dirname(dest))
+			except OSError: pass
+			if link is not None:
+				archive.make_link(link, dest)
+				continue
+			if os.path.islink(dest): os.remove(dest)
+			with open(dest, 'wb') as out:
+				for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+					out.write(data)
+
+	def read(self, arcname):
+		if arcname == 'MANIFEST':
+			return self.index['manifest'].encode('utf-8')
+		for name, f in self.files():
+			if name == arcname: return f.read()
+		return None
+
+	def refs(self):
+		for entry in self.index['files']:
+			for hash in entry.get('chunks', []):
+				yield hash
+
+	def close(self):
+		pass
+
+def is_chunked(path):
+	return path.endswith(EXT)
+
+def open_package(path, store = None):
+	if is_chunked(path):
+		return ChunkedPackage(path, store)
+	return archive.open(path)
+
+def read_manifest(path):
+	with open(path) as f:
+		return json.load(f)['manifest']
+
+def import_archive(path, store):
+	arc = archive.open(path)
+	if arc is None: return None
+	try:
+		files = []
+		for name, f, link in arc.members():
+			if link is not None:
+				files.append({'path': name, 'link': link})
+				continue
+			if name == 'MANIFEST':
+				f.close()
+				continue
+			chunks = []
+			size = 0
+			try:
+				for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+					chunks.append(store.put(data))
+					size += len(data)
+			finally: f.close()
+			files.append({'path': name, 'size': size, 'chunks': chunks})
+		manifest = arc.read('MANIFEST')
+	finally: arc.close()
+	if manifest is None: return None
+
+	index = path + EXT
+	tmp = index + '.tmp'
+	with open(tmp, 'w') as f:
+		json.dump({'manifest': manifest.decode('utf-8'), 'files': files}, f, sort_keys=True)
+	os.replace(tmp, index)
+	return index
+
+# the shard index and temporary files sit next to the packages, as do
+# subdirectories such as .deltas
+INDEX_FILES = ['repo.xml']
+
+def package_indexes(base):
+	for root, dirs, files in os.walk(base):
+		for dir in sorted(dirs):
+			if dir.startswith('.'): continue
+			for filename in sorted(os.listdir(os.path.join(root, dir))):
+				path = os.path.join(root, dir, filename)
+				if filename in INDEX_FILES or filename.endswith('.tmp') or not os.path.isfile(path): continue
+				yield path
+		break
+
+def main():
+	parser = argparse.ArgumentParser(description='Manages the deduplicated chunk store in packages/' + STORE)
+	sub = parser.add_subparsers(dest='command')
+	imp = sub.add_parser('import', help='replace package archives with chunk lists')
+	imp.add_argument('paths', nargs='*', help='archives to import, defaults to all in packages/<platform>')
+	imp.add_argument('--keep', action='store_true', help='keep the archives next to their chunk lists')
+	sub.add_parser('gc', help='remove chunks no package refers to')
+	args = parser.parse_args()
+
+	base = 'packages'
+	store = ChunkStore(os.path.join(base, STORE))
+	if args.command == 'import':
+		paths = args.paths or [path for path in package_indexes(base) if not is_chunked(path)]
+		for path in paths:
+			index = import_archive(path, store)
+			if index is None: continue
+			sys.stdout.write('+ {}\n'.format(index))
+			if not args.keep:
+				os.remove(path)
+	elif args.command == 'gc':
+		live = set()
+		for path in package_indexes(base):
+			if is_chunked(path):
+				live.update(ChunkedPackage(path, store).refs())
+		count, size = store.gc(live)
+		sys.stdout.write('removed {0} chunks, {1} bytes\n'.format(count, size))
+	else:
+		parser.print_help()
+
+if __name__ == '__main__':
+	main()
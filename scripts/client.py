@@ -0,0 +1,356 @@
+import os, sys, shutil, hashlib, argparse, threading, queue
+import http.client as httplib
+import xml.etree.ElementTree as ET
+from io import BytesIO
+from urllib.parse import urlsplit, quote
+from concurrent.futures import ThreadPoolExecutor
+import archive, recipe, buildrepo, chunkstore, delta, verify
+
+CHUNK_SIZE = 64 * 1024
+
+class HTTPError(Exception):
+	def __init__(self, url, status, reason):
+		Exception.__init__(self, '{0}: {1} {2}'.format(url, status, reason))
+		self.url = url
+		self.status = status
+
+class ResolveError(Exception):
+	pass
+
+class VerifyError(Exception):
+	pass
+
+def default_platform():
+	if recipe.is_apple(): return 'DARWIN'
+	if recipe.is_windows(): return 'WINDOWS'
+	return 'POSIX'
+
+class ConnectionPool:
+	def __init__(self, url, size):
+		parts = urlsplit(url)
+		self.scheme = parts.scheme
+		self.host = parts.netloc
+		self.base = parts.path.rstrip('/')
+		self.size = size
+		self.idle = queue.LifoQueue()
+
+	def connect(self):
+		if self.scheme == 'https':
+			return httplib.HTTPSConnection(self.host, timeout=60)
+		return httplib.HTTPConnection(self.host, timeout=60)
+
+	def acquire(self):
+		try: return self.idle.get_nowait()
+		except queue.Empty: return self.connect()
+
+	def release(self, conn):
+		if self.idle.qsize() < self.size:
+			self.idle.put(conn)
+		else:
+			conn.close()
+
+	def close(self):
+		while True:
+			try: self.idle.get_nowait().close()
+			except queue.Empty: break
+
+	def request(self, path, headers = {}):
+		url = self.base + '/' + quote(path.replace('\\', '/'))
+		# an idle keep-alive connection may have been dropped by the
+		# server in the meantime; retry once on a fresh one
+		for attempt in range(2):
+			conn = self.acquire()
+			try:
+				conn.request('GET', url, headers=headers)
+				return conn, conn.getresponse()
+			except (httplib.HTTPException, OSError):
+				conn.close()
+				if attempt: raise
+
+	def get(self, path, out, headers = {}):
+		conn, resp = self.request(path, headers)
+		try:
+			if resp.status not in (200, 206):
+				resp.read()
+				raise HTTPError(path, resp.status, resp.reason)
+			shutil.copyfileobj(resp, out, CHUNK_SIZE)
+		except:
+			conn.close()
+			raise
+		self.release(conn)
+		return resp
+
+	def fetch(self, path):
+		out = BytesIO()
+		self.get(path, out)
+		return out.getvalue()
+
+def parse_repo(data, platform = None):
+	result = buildrepo.PlatformRepo()
+	for node in ET.fromstring(data).findall('package'):
+		if platform is not None and node.get('platform') != platform:
+			continue
+		result.append(buildrepo.RepoPkg(node.get('pkg'), {
+			'id': node.get('id'),
+			'name': node.get('name'),
+			'version': node.get('version'),
+			'platform': node.get('platform'),
+			'provides': [sub.get('name') for sub in node.findall('provides')],
+			'requires': [sub.get('name') for sub in node.findall('requires')],
+			'deltas': [{'from': sub.get('from'), 'pkg': sub.get('pkg'), 'size': int(sub.get('size'))} for sub in node.findall('delta')],
+		}))
+	result.repopulate()
+	return result
+
+def read_package(path, store = None):
+	arc = chunkstore.open_package(path, store)
+	if arc is None: raise VerifyError('{0}: not an archive'.format(path))
+	try:
+		hash = hashlib.sha256()
+		for name, f, link in arc.members():
+			if not name.startswith('files/'):
+				if f is not None: f.close()
+				continue
+			if link is not None:
+				archive.hash_link(hash, link)
+				continue
+			try:
+				for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+					hash.update(chunk)
+			finally: f.close()
+		manifest = arc.read('MANIFEST')
+	finally: arc.close()
+	if manifest is None: raise VerifyError('{0}: MANIFEST missing'.format(path))
+	return hash, manifest.decode('utf-8')
+
+def verify_package(path, expected, store = None):
+	try:
+		hash, manifest = read_package(path, store)
+	except (chunkstore.ChunkError, ValueError) as e:
+		raise VerifyError('{0}: {1}'.format(path, e))
+	head, body = manifest.split('\n', 1)
+	hash.update(body.encode('utf-8'))
+	actual = hash.hexdigest()
+	if head != u'Id: {}'.format(actual):
+		raise VerifyError('{0}: contents do not match MANIFEST {1}'.format(path, head))
+	if expected is not None and actual != expected:
+		raise VerifyError('{0}: expected Id {1}, got {2}'.format(path, expected, actual))
+	return manifest
+
+def extract_package(path, prefix, store = None):
+	arc = chunkstore.open_package(path, store)
+	try:
+		for name, f, link in arc.members():
+			try:
+				if not name.startswith('files/'): continue
+				name = name[len('files/'):]
+				if not archive.is_safe(name) or (link is not None and not archive.is_safe_link(name, link)):
+					raise VerifyError('{0}: {1} points outside of the prefix'.format(path, name))
+				dest = os.path.join(prefix, *name.split('/'))
+				if not archive.is_inside(prefix, os.path.dirname(dest)):
+					raise VerifyError('{0}: {1} points outside of the prefix'.format(path, name))
+				try: os.makedirs(os.path.dirname(dest))
+				except OSError: pass
+				if link is not None:
+					archive.make_link(link, dest)
+					continue
+				if os.path.islink(dest): os.remove(dest)
+				with open(dest, 'wb') as out:
+					shutil.copyfileobj(f, out, CHUNK_SIZE)
+			finally:
+				if f is not None: f.close()
+	finally: arc.close()
+
+class Client:
+	def __init__(self, server, prefix, platform = None, jobs = 4, out = sys.stdout):
+		self.pool = ConnectionPool(server, jobs)
+		self.prefix = prefix
+		self.platform = platform or default_platform()
+		self.jobs = jobs
+		self.out = out
+		self.meta = os.path.join(prefix, '.tpm')
+		self.chunks = chunkstore.ChunkStore(os.path.join(self.meta, 'chunks'))
+		self.lock = threading.Lock()
+
+	def log(self, text):
+		with self.lock:
+			self.out.write(text)
+
+	def load_repo(self):
+		try:
+			index = ET.fromstring(self.pool.fetch('index.xml'))
+		except HTTPError as e:
+			if e.status != 404: raise
+			index = None
+
+		if index is not None:
+			for shard in index.findall('shard'):
+				if shard.get('platform') != self.platform: continue
+				data = self.pool.fetch(shard.get('href'))
+				if hashlib.sha256(data).hexdigest() != shard.get('sha256'):
+					raise VerifyError('{0}: does not match index.xml'.format(shard.get('href')))
+				repo = parse_repo(data)
+				break
+			else:
+				repo = buildrepo.PlatformRepo()
+		else:
+			repo = parse_repo(self.pool.fetch('repo.xml'), self.platform)
+
+		repo.minimize(self.out)
+		return repo
+
+	def provider(self, repo, name):
+		if name not in repo.provides: return None
+		return max(repo.provides[name], key=lambda pkg: (recipe.version_key(pkg.version), pkg.uri))
+
+	def resolve(self, repo, names):
+		result = []
+		visited = set()
+		def visit(name, chain):
+			pkg = self.provider(repo, name)
+			if pkg is None:
+				raise ResolveError('repo cannot supply package for \'{0}\' requirement{1}'.format(
+					name, ''.join(' (required by {})'.format(uri) for uri in reversed(chain))))
+			if pkg.uri in visited: return
+			visited.add(pkg.uri)
+			for req in pkg.requires:
+				visit(req, chain + [pkg.uri])
+			result.append(pkg)
+		for name in names:
+			visit(name, [])
+		return result
+
+	def installed(self, name):
+		try:
+			with open(os.path.join(self.meta, 'installed', name), 'rb') as f:
+				return f.read().decode('utf-8')
+		except (IOError, OSError):
+			return None
+
+	def installed_id(self, name):
+		manifest = self.installed(name)
+		if manifest is None: return None
+		return manifest.split('\n', 1)[0][len('Id: '):]
+
+	def download(self, pkg):
+		if not archive.is_safe(pkg.uri):
+			raise VerifyError('{}: unsafe package path'.format(pkg.uri))
+		path = os.path.join(self.meta, 'cache', *pkg.uri.replace('\\', '/').split('/'))
+		try: os.makedirs(os.path.dirname(path))
+		except OSError: pass
+		if os.path.exists(path):
+			try: return path, self.verify(path, pkg)
+			except VerifyError: pass
+
+		self.log('+ GET {}\n'.format(pkg.uri))
+		tmp = os.path.join(os.path.dirname(path), 'part.' + os.path.basename(path))
+		with open(tmp, 'wb') as out:
+			self.pool.get(pkg.uri, out)
+		try:
+			manifest = self.verify(tmp, pkg)
+		except:
+			os.remove(tmp)
+			raise
+		os.replace(tmp, path)
+		return path, manifest
+
+	def verify(self, path, pkg):
+		if chunkstore.is_chunked(pkg.uri):
+			self.fetch_chunks(chunkstore.ChunkedPackage(path, self.chunks))
+		return verify_package(path, pkg.id, self.chunks)
+
+	def fetch_chunks(self, index):
+		missing = []
+		for hash in index.refs():
+			if hash not in missing and not self.chunks.has(hash):
+				missing.append(hash)
+		for hash in missing:
+			try:
+				self.chunks.put_compressed(hash, self.pool.fetch(chunkstore.chunk_uri(hash)))
+			except chunkstore.ChunkError as e:
+				raise VerifyError(str(e))
+
+	def usable_delta(self, pkg):
+		manifest = self.installed(pkg.name)
+		if manifest is None or not pkg.deltas: return None
+		installed_id = manifest.split('\n', 1)[0][len('Id: '):]
+		for item in pkg.deltas:
+			if item['from'] != installed_id: continue
+			table = recipe.parse_manifset(manifest)
+			if not table['files'] or verify.verify_tree(self.prefix, table['files'], self.jobs, True, table['links']):
+				return None
+			return item
+		return None
+
+	def fetch(self, pkg):
+		item = self.usable_delta(pkg)
+		if item is not None and archive.is_safe(item['pkg']):
+			path = os.path.join(self.meta, 'cache', *item['pkg'].split('/'))
+			try: os.makedirs(os.path.dirname(path))
+			except OSError: pass
+			self.log('+ GET {}\n'.format(item['pkg']))
+			try:
+				with open(path, 'wb') as out:
+					self.pool.get(item['pkg'], out)
+				return path, None
+			except (HTTPError, httplib.HTTPException, OSError) as e:
+				self.log('{0}: warning: {1}, downloading the full package\n'.format(pkg.uri, e))
+		return self.download(pkg)
+
+	def install(self, names):
+		repo = self.load_repo()
+		pkgs = [pkg for pkg in self.resolve(repo, names) if self.installed_id(pkg.name) != pkg.id]
+		with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+			downloaded = list(pool.map(self.fetch, pkgs))
+
+		for pkg, (path, manifest) in zip(pkgs, downloaded):
+			if manifest is None:
+				if self.patch(pkg, path): continue
+				path, manifest = self.download(pkg)
+			self.log('+ install {0}-{1}\n'.format(pkg.name, pkg.version))
+			extract_package(path, self.prefix, self.chunks)
+			self.record(pkg, manifest)
+		return pkgs
+
+	def patch(self, pkg, path):
+		try:
+			manifest = delta.apply_delta(path, self.prefix, pkg.id, os.path.join(self.meta, 'staging'))
+		except delta.DeltaError as e:
+			self.log('{0}: warning: {1}, downloading the full package\n'.format(pkg.uri, e))
+			return False
+		finally:
+			os.remove(path)
+		self.log('+ patch {0}-{1}\n'.format(pkg.name, pkg.version))
+		self.record(pkg, manifest)
+		return True
+
+	def record(self, pkg, manifest):
+		installed = os.path.join(self.meta, 'installed')
+		try: os.makedirs(installed)
+		except OSError: pass
+		with open(os.path.join(installed, pkg.name), 'wb') as f:
+			f.write(manifest.encode('utf-8'))
+
+	def close(self):
+		self.pool.close()
+
+def main():
+	parser = argparse.ArgumentParser(description='Installs packages providing the requested names from a TPM repo.')
+	parser.add_argument('names', nargs='+', metavar='name', help='`Provides` names to install')
+	parser.add_argument('-s', '--server', required=True, help='base URL of the repo server')
+	parser.add_argument('-o', '--prefix', default='.', help='directory to install packages into')
+	parser.add_argument('-p', '--platform', help='platform to install for, e.g. POSIX')
+	parser.add_argument('-j', '--jobs', type=int, default=4, help='number of concurrent downloads')
+	args = parser.parse_args()
+
+	client = Client(args.server, args.prefix, args.platform and args.platform.upper(), args.jobs)
+	try:
+		client.install(args.names)
+	except (HTTPError, ResolveError, VerifyError) as e:
+		sys.stderr.write('error: {}\n'.format(e))
+		exit(1)
+	finally:
+		client.close()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,86 @@
+import os, json, shutil, subprocess
+
+LAUNCHERS = ['ccache', 'sccache']
+
+# cmake modes which do not configure a project and take no -D
+NOT_CONFIGURING = ['--build', '--install', '--open', '-E', '-P', '--help', '--version', '--system-information']
+
+def default_launcher():
+	return os.environ.get('TPM_CCACHE', 'auto')
+
+def default_dir():
+	return os.path.abspath(os.path.expanduser(os.environ.get('TPM_CCACHE_DIR', os.path.join('~', '.tpm', 'ccache'))))
+
+def default_size():
+	return os.environ.get('TPM_CCACHE_SIZE', '5G')
+
+def find(name):
+	if name == 'auto':
+		for candidate in LAUNCHERS:
+			path = shutil.which(candidate)
+			if path is not None: return path
+		return None
+	return shutil.which(name)
+
+class CompilerCache:
+	def __init__(self, path, dir = None, size = None):
+		self.path = path
+		self.kind = 'sccache' if os.path.basename(path).startswith('sccache') else 'ccache'
+		self.dir = dir or default_dir()
+		self.size = size or default_size()
+		self.log = None
+		self.before = None
+
+	def environ(self, env):
+		env = dict(env)
+		if self.kind == 'sccache':
+			env['SCCACHE_DIR'] = self.dir
+			env['SCCACHE_CACHE_SIZE'] = self.size
+		else:
+			env['CCACHE_DIR'] = self.dir
+			env['CCACHE_MAXSIZE'] = self.size
+			if self.log is not None:
+				env['CCACHE_STATSLOG'] = self.log
+		return env
+
+	def cmake(self, args):
+		if args and args[0] in NOT_CONFIGURING:
+			return ['cmake'] + args
+		return ['cmake',
+			'-DCMAKE_C_COMPILER_LAUNCHER={}'.format(self.path),
+			'-DCMAKE_CXX_COMPILER_LAUNCHER={}'.format(self.path)] + args
+
+	# ccache logs the outcome of every compilation of this build to its
+	# own file; the sccache server is shared, so its totals are compared
+	def start(self, log):
+		if self.kind == 'sccache':
+			self.before = self.sccache_stats()
+			return
+		self.log = os.path.abspath(log)
+		if os.path.exists(self.log):
+			os.remove(self.log)
+
+	def sccache_stats(self):
+		try:
+			output = subprocess.check_output([self.path, '--show-stats', '--stats-format', 'json'], env=self.environ(os.environ))
+			stats = json.loads(output.decode('utf-8'))['stats']
+		except (OSError, subprocess.CalledProcessError, ValueError, KeyError):
+			return (0, 0)
+		def count(name):
+			return sum(stats.get(name, {}).get('counts', {}).values())
+		return count('cache_hits'), count('cache_misses')
+
+	def stats(self):
+		if self.kind == 'sccache':
+			hits, misses = self.sccache_stats()
+			return hits - self.before[0], misses - self.before[1]
+		hits, misses = 0, 0
+		try:
+			with open(self.log) as f:
+				for line in f:
+					line = line.strip()
+					if line.endswith('_cache_hit'): hits += 1
+					elif line == 'cache_miss': misses += 1
+		except (IOError, OSError):
+			pass
+		return hits, misses
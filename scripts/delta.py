@@ -0,0 +1,245 @@
+import os, json, struct, hashlib, zipfile
+import recipe, archive, chunkstore
+
+BLOCK_SIZE = 4096
+COPY = b'C'
+INSERT = b'I'
+EXT = '.delta'
+DIR = '.deltas'
+
+class DeltaError(Exception):
+	pass
+
+def diff(old, new):
+	index = {}
+	for offset in range(0, len(old) - BLOCK_SIZE + 1, BLOCK_SIZE):
+		block = old[offset:offset + BLOCK_SIZE]
+		if block not in index:
+			index[block] = offset
+
+	out = []
+	literal = []
+	copy = None
+	for pos in range(0, len(new), BLOCK_SIZE):
+		block = new[pos:pos + BLOCK_SIZE]
+		offset = index.get(block)
+		if offset is None:
+			if copy is not None:
+				out.append(COPY + struct.pack('>QI', copy[0], copy[1]))
+				copy = None
+			literal.append(block)
+			continue
+		if literal:
+			data = b''.join(literal)
+			out.append(INSERT + struct.pack('>I', len(data)) + data)
+			literal = []
+		if copy is not None and copy[0] + copy[1] == offset:
+			copy = (copy[0], copy[1] + len(block))
+			continue
+		if copy is not None:
+			out.append(COPY + struct.pack('>QI', copy[0], copy[1]))
+		copy = (offset, len(block))
+
+	if copy is not None:
+		out.append(COPY + struct.pack('>QI', copy[0], copy[1]))
+	if literal:
+		data = b''.join(literal)
+		out.append(INSERT + struct.pack('>I', len(data)) + data)
+	return b''.join(out)
+
+def patch(old, ops):
+	out = []
+	pos = 0
+	while pos < len(ops):
+		op = ops[pos:pos + 1]
+		if op == COPY:
+			offset, length = struct.unpack('>QI', ops[pos + 1:pos + 13])
+			if offset + length > len(old):
+				raise DeltaError('copy past the end of the old file')
+			out.append(old[offset:offset + length])
+			pos += 13
+		elif op == INSERT:
+			length, = struct.unpack('>I', ops[pos + 1:pos + 5])
+			out.append(ops[pos + 5:pos + 5 + length])
+			pos += 5 + length
+		else:
+			raise DeltaError('unknown delta operation {!r}'.format(op))
+	return b''.join(out)
+
+def delta_name(old_id, new_id):
+	return '{0}-{1}{2}'.format(old_id, new_id, EXT)
+
+def read_files(path, store, wanted):
+	result = {}
+	pkg = chunkstore.open_package(path, store)
+	try:
+		for name, f in pkg.files():
+			try:
+				if name[len('files/'):] in wanted:
+					result[name[len('files/'):]] = f.read()
+			finally: f.close()
+	finally: pkg.close()
+	return result
+
+def make_delta(old_id, old_path, old_files, old_links, new_path, new_files, dest, store):
+	old_table = dict((path, sha256) for path, size, sha256 in old_files)
+	new_table = dict((path, sha256) for path, size, sha256 in new_files)
+	changed = set(path for path in new_table if path in old_table and old_table[path] != new_table[path])
+	old_data = read_files(old_path, store, changed)
+
+	try: os.makedirs(os.path.dirname(dest))
+	except OSError: pass
+	tmp = dest + '.tmp'
+	entries = []
+	pkg = chunkstore.open_package(new_path, store)
+	try:
+		with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as out:
+			for name, f, link in pkg.members():
+				if link is not None:
+					if name.startswith('files/'):
+						entries.append({'path': name[len('files/'):], 'op': 'link', 'target': link})
+					continue
+				try:
+					if not name.startswith('files/'): continue
+					path = name[len('files/'):]
+					if path in old_table and old_table[path] == new_table.get(path):
+						entries.append({'path': path, 'op': 'keep'})
+						continue
+					data = f.read()
+				finally: f.close()
+				member = 'data/{}'.format(len(entries))
+				op = 'add'
+				if path in old_data:
+					ops = diff(old_data[path], data)
+					if len(ops) < len(data):
+						op, data = 'patch', ops
+				out.writestr(member, data)
+				entries.append({'path': path, 'op': op, 'data': member})
+			manifest = pkg.read('MANIFEST')
+			new_links = set(entry['path'] for entry in entries if entry['op'] == 'link')
+			head = manifest.decode('utf-8').split('\n', 1)[0]
+			info = {
+				'from': old_id,
+				'to': head[len('Id: '):],
+				'files': entries,
+				'removed': sorted(path for path in set(old_table) | set(path for path, target in old_links)
+					if path not in new_table and path not in new_links),
+			}
+			out.writestr('DELTA', json.dumps(info, sort_keys=True))
+			out.writestr('MANIFEST', manifest)
+	finally: pkg.close()
+	os.replace(tmp, dest)
+
+def read_file(path):
+	with open(path, 'rb') as f:
+		return f.read()
+
+def apply_delta(path, prefix, expected, staging):
+	try:
+		delta = zipfile.ZipFile(path)
+	except (zipfile.BadZipFile, IOError, OSError) as e:
+		raise DeltaError('{0}: {1}'.format(path, e))
+
+	staged = []
+	try:
+		with delta:
+			info = json.loads(delta.read('DELTA').decode('utf-8'))
+			manifest = delta.read('MANIFEST').decode('utf-8')
+			if info['to'] != expected:
+				raise DeltaError('{0}: produces {1}, expected {2}'.format(path, info['to'], expected))
+
+			table = dict((name, sha256) for name, size, sha256 in recipe.parse_manifset(manifest)['files'])
+			hash = hashlib.sha256()
+			try: os.makedirs(staging)
+			except OSError: pass
+			for entry in info['files']:
+				name = entry['path']
+				if not archive.is_safe(name) or (entry['op'] == 'link' and not archive.is_safe_link(name, entry['target'])):
+					raise DeltaError('{0}: {1} points outside of the prefix'.format(path, name))
+				dest = os.path.join(prefix, *name.split('/'))
+				if not archive.is_inside(prefix, os.path.dirname(dest)):
+					raise DeltaError('{0}: {1} points outside of the prefix'.format(path, name))
+				if entry['op'] == 'link':
+					archive.hash_link(hash, entry['target'])
+					tmp = os.path.join(staging, str(len(staged)))
+					os.symlink(entry['target'], tmp)
+					staged.append((tmp, dest))
+					continue
+				try:
+					if entry['op'] == 'keep':
+						data = read_file(dest)
+					elif entry['op'] == 'patch':
+						data = patch(read_file(dest), delta.read(entry['data']))
+					else:
+						data = delta.read(entry['data'])
+				except (IOError, OSError) as e:
+					raise DeltaError('{0}: {1}'.format(name, e))
+				if hashlib.sha256(data).hexdigest() != table.get(name):
+					raise DeltaError('{0}: patched file does not match MANIFEST'.format(name))
+				hash.update(data)
+				if entry['op'] == 'keep': continue
+				tmp = os.path.join(staging, str(len(staged)))
+				with open(tmp, 'wb') as f:
+					f.write(data)
+				staged.append((tmp, dest))
+
+		head, body = manifest.split('\n', 1)
+		hash.update(body.encode('utf-8'))
+		if head != u'Id: {}'.format(expected) or hash.hexdigest() != expected:
+			raise DeltaError('{0}: patched package does not match Id {1}'.format(path, expected))
+
+		# links replaced earlier in the list can redirect later parents
+		while staged:
+			tmp, dest = staged[0]
+			if not archive.is_inside(prefix, os.path.dirname(dest)):
+				raise DeltaError('{0}: {1} points outside of the prefix'.format(path, os.path.relpath(dest, prefix)))
+			try: os.makedirs(os.path.dirname(dest))
+			except OSError: pass
+			os.replace(tmp, dest)
+			staged.pop(0)
+		for name in info['removed']:
+			dest = os.path.join(prefix, *name.split('/'))
+			if not archive.is_safe(name) or not archive.is_inside(prefix, os.path.dirname(dest)): continue
+			try: os.remove(dest)
+			except OSError: pass
+		return manifest
+	finally:
+		for tmp, dest in staged:
+			os.remove(tmp)
+
+def update_deltas(base, repo, store, generate, out):
+	groups = {}
+	for pkg in repo:
+		key = (pkg.name, pkg.platform)
+		if key not in groups:
+			groups[key] = []
+		groups[key].append(pkg)
+
+	wanted = set()
+	for key in sorted(groups):
+		pkgs = sorted(groups[key], key=lambda pkg: (recipe.version_key(pkg.version), pkg.uri))
+		for old, new in zip(pkgs, pkgs[1:]):
+			new.deltas = []
+			dir = os.path.join(base, os.path.dirname(new.uri), DIR)
+			dest = os.path.join(dir, delta_name(old.id, new.id))
+			wanted.add(os.path.abspath(dest))
+			if not os.path.exists(dest):
+				if not generate or not old.files or not new.files: continue
+				out.write('+ delta {0} {1} -> {2}\n'.format(new.name, old.version, new.version))
+				make_delta(old.id, os.path.join(base, old.uri), old.files, old.links, os.path.join(base, new.uri), new.files, dest, store)
+			if os.path.getsize(dest) >= os.path.getsize(os.path.join(base, new.uri)):
+				continue
+			uri = os.path.relpath(dest, base).replace('\\', '/')
+			new.deltas.append({'from': old.id, 'pkg': uri, 'size': os.path.getsize(dest)})
+
+	if not generate: return
+	for root, dirs, files in os.walk(base):
+		for dir in dirs:
+			deltas = os.path.join(root, dir, DIR)
+			if not os.path.isdir(deltas): continue
+			for filename in os.listdir(deltas):
+				path = os.path.join(deltas, filename)
+				if os.path.abspath(path) not in wanted:
+					out.write('+ rm {}\n'.format(path))
+					os.remove(path)
+		break
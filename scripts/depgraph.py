@@ -0,0 +1,124 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+def positive_int(value):
+	try: result = int(value)
+	except ValueError: result = 0
+	if result < 1:
+		raise argparse.ArgumentTypeError('expected a number of at least 1, got {!r}'.format(value))
+	return result
+
+class DepGraph:
+	def __init__(self, recipes):
+		self.provides = {}
+		self.requires = {}
+		self.deps = {}
+		for conf in recipes:
+			self.requires[conf] = set()
+			for pkg in recipes[conf].packages:
+				for name in pkg.provides:
+					if name not in self.provides:
+						self.provides[name] = set()
+					self.provides[name].add(conf)
+				self.requires[conf].update(pkg.requires)
+
+		for conf in recipes:
+			deps = set()
+			for name in self.requires[conf]:
+				if name in self.provides:
+					deps.update(self.provides[name])
+			deps.discard(conf)
+			self.deps[conf] = deps
+
+	def unsatisfied(self):
+		missing = []
+		for conf in sorted(self.requires):
+			for name in sorted(self.requires[conf]):
+				if name not in self.provides:
+					missing.append((conf, name))
+		return missing
+
+	def cycles(self):
+		WHITE, GREY, BLACK = 0, 1, 2
+		color = dict((conf, WHITE) for conf in self.deps)
+		found = []
+		for start in sorted(self.deps):
+			if color[start] != WHITE: continue
+			path = [start]
+			stack = [iter(sorted(self.deps[start]))]
+			color[start] = GREY
+			while stack:
+				dep = next(stack[-1], None)
+				if dep is None:
+					color[path.pop()] = BLACK
+					stack.pop()
+					continue
+				if color[dep] == GREY:
+					found.append(path[path.index(dep):] + [dep])
+				elif color[dep] == WHITE:
+					color[dep] = GREY
+					path.append(dep)
+					stack.append(iter(sorted(self.deps[dep])))
+		return found
+
+	def order(self):
+		pending = dict((conf, len(self.deps[conf])) for conf in self.deps)
+		dependents = dict((conf, []) for conf in self.deps)
+		for conf in self.deps:
+			for dep in self.deps[conf]:
+				dependents[dep].append(conf)
+		ready = sorted(conf for conf in pending if not pending[conf])
+		result = []
+		while ready:
+			conf = ready.pop(0)
+			result.append(conf)
+			for dep in dependents[conf]:
+				pending[dep] -= 1
+				if not pending[dep]:
+					ready.append(dep)
+			ready.sort()
+		return result
+
+	def report(self, out):
+		failed = False
+		for conf, name in self.unsatisfied():
+			out.write('{0}: error: no recipe provides \'{1}\'\n'.format(conf, name))
+			failed = True
+		for cycle in self.cycles():
+			out.write('{0}: error: dependency cycle: {1}\n'.format(cycle[0], ' -> '.join(cycle)))
+			failed = True
+		return not failed
+
+	def schedule(self, confs, jobs, build):
+		if jobs < 1: raise ValueError('jobs must be at least 1')
+		confs = set(confs)
+		pending = {}
+		dependents = dict((conf, []) for conf in confs)
+		for conf in confs:
+			deps = self.deps[conf] & confs
+			pending[conf] = len(deps)
+			for dep in deps:
+				dependents[dep].append(conf)
+
+		ready = sorted(conf for conf in confs if not pending[conf])
+		running = {}
+		retval = 0
+		with ThreadPoolExecutor(max_workers=jobs) as pool:
+			while ready or running:
+				while ready and not retval and len(running) < jobs:
+					conf = ready.pop(0)
+					running[pool.submit(build, conf)] = conf
+				if not running: break
+				done, _ = wait(running, return_when=FIRST_COMPLETED)
+				for future in done:
+					conf = running.pop(future)
+					result = future.result()
+					if result:
+						if not retval: retval = result
+						continue
+					for dep in dependents[conf]:
+						pending[dep] -= 1
+						if not pending[dep]:
+							ready.append(dep)
+				ready.sort()
+		return retval
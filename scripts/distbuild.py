@@ -0,0 +1,204 @@
+import os, sys, json, queue, socket, struct, argparse, threading, subprocess
+
+CHUNK_SIZE = 64 * 1024
+ATTEMPTS = 3
+
+class ProtocolError(Exception):
+	pass
+
+def parse_address(address):
+	host, _, port = address.rpartition(':')
+	return host, int(port)
+
+def send(sock, header, payload = b''):
+	if payload: header = dict(header, size=len(payload))
+	data = json.dumps(header, sort_keys=True).encode('utf-8')
+	sock.sendall(struct.pack('>I', len(data)) + data + payload)
+
+def read_exact(f, size):
+	data = f.read(size)
+	if len(data) != size:
+		raise ProtocolError('connection closed')
+	return data
+
+def recv(f):
+	size, = struct.unpack('>I', read_exact(f, 4))
+	try:
+		return json.loads(read_exact(f, size).decode('utf-8'))
+	except ValueError as e:
+		raise ProtocolError('bad message: {}'.format(e))
+
+def copy(f, out, size):
+	while size:
+		data = read_exact(f, min(size, CHUNK_SIZE))
+		out.write(data)
+		size -= len(data)
+
+def is_safe(path):
+	path = os.path.normpath(path)
+	return not os.path.isabs(path) and path != '..' and not path.startswith('..' + os.sep)
+
+class RemoteWorker:
+	def __init__(self, sock):
+		self.sock = sock
+		self.rfile = sock.makefile('rb')
+		hello = recv(self.rfile)
+		if hello.get('type') != 'hello':
+			raise ProtocolError('expected hello, got {}'.format(hello.get('type')))
+		self.name = hello.get('name', '?')
+
+	def run(self, conf, text, names, flags, out):
+		send(self.sock, {'type': 'job', 'recipe': conf, 'packages': names, 'flags': flags}, text)
+		received = []
+		try:
+			while True:
+				msg = recv(self.rfile)
+				if msg['type'] == 'log':
+					out.write(msg['data'])
+				elif msg['type'] == 'file':
+					if msg['name'] not in names:
+						raise ProtocolError('unexpected package {}'.format(msg['name']))
+					path = os.path.join('packages', msg['name'])
+					try: os.makedirs(os.path.dirname(path))
+					except OSError: pass
+					tmp = '{0}.{1}.part'.format(path, self.name.replace(':', '-'))
+					with open(tmp, 'wb') as f:
+						received.append((tmp, path))
+						copy(self.rfile, f, msg['size'])
+				elif msg['type'] == 'done':
+					break
+				else:
+					raise ProtocolError('unexpected message {}'.format(msg['type']))
+			if msg['status']: return msg['status']
+			for tmp, path in received:
+				os.replace(tmp, path)
+			received = []
+			return 0
+		finally:
+			for tmp, path in received:
+				os.remove(tmp)
+
+	def close(self):
+		self.rfile.close()
+		self.sock.close()
+
+class Coordinator:
+	def __init__(self, address, out):
+		self.out = out
+		self.idle = queue.Queue()
+		self.workers = []
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.server.bind(address)
+		self.server.listen(16)
+		self.out.write('+ waiting for workers on {0}:{1}\n'.format(*self.server.getsockname()))
+		thread = threading.Thread(target=self.accept)
+		thread.daemon = True
+		thread.start()
+
+	def accept(self):
+		while True:
+			try: sock, addr = self.server.accept()
+			except OSError: return
+			try: worker = RemoteWorker(sock)
+			except (OSError, ProtocolError) as e:
+				self.out.write('{0}: worker rejected: {1}\n'.format(addr[0], e))
+				sock.close()
+				continue
+			self.out.write('+ worker {} connected\n'.format(worker.name))
+			self.workers.append(worker)
+			self.idle.put(worker)
+
+	def build(self, conf, text, names, flags):
+		for attempt in range(ATTEMPTS):
+			worker = self.idle.get()
+			self.out.write('+ {0} -> {1}\n'.format(conf, worker.name))
+			try:
+				retval = worker.run(conf, text, names, flags, self.out)
+			except (OSError, ProtocolError) as e:
+				self.out.write('{0}: worker {1} lost: {2}\n'.format(conf, worker.name, e))
+				self.workers.remove(worker)
+				worker.close()
+				continue
+			self.idle.put(worker)
+			return retval
+		self.out.write('{0}: giving up after {1} attempts\n'.format(conf, ATTEMPTS))
+		return 1
+
+	def close(self):
+		self.server.close()
+		for worker in self.workers:
+			worker.close()
+
+class LogWriter:
+	def __init__(self, sock):
+		self.sock = sock
+
+	def write(self, data):
+		send(self.sock, {'type': 'log', 'data': data})
+
+def run_job(sock, rfile, job, out):
+	text = read_exact(rfile, job.get('size', 0))
+	conf = job['recipe']
+	names = job['packages']
+	if not is_safe(conf) or not all(is_safe(name) for name in names):
+		out.write('{}: refusing paths outside of the work directory\n'.format(conf))
+		return 1
+	try: os.makedirs(os.path.dirname(conf))
+	except OSError: pass
+	with open(conf, 'wb') as f:
+		f.write(text)
+
+	flags = [flag for flag in job.get('flags', []) if flag in ('--stream', '--incremental', '--ccache')]
+	cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build.py')] + flags + [conf]
+	proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	for line in iter(proc.stdout.readline, b''):
+		out.write(line.decode('utf-8', 'replace'))
+	retval = proc.wait()
+	if retval: return retval
+
+	for name in names:
+		path = os.path.join('packages', name)
+		if not os.path.exists(path):
+			out.write('{0}: build did not produce {1}\n'.format(conf, path))
+			return 1
+	for name in names:
+		path = os.path.join('packages', name)
+		with open(path, 'rb') as f:
+			send(sock, {'type': 'file', 'name': name, 'size': os.fstat(f.fileno()).st_size})
+			sock.sendfile(f)
+	return 0
+
+def run_worker(address, name):
+	sock = socket.create_connection(address)
+	rfile = sock.makefile('rb')
+	try:
+		send(sock, {'type': 'hello', 'name': name})
+		out = LogWriter(sock)
+		while True:
+			try: job = recv(rfile)
+			except ProtocolError: return
+			if job.get('type') != 'job':
+				raise ProtocolError('unexpected message {}'.format(job.get('type')))
+			sys.stdout.write('+ build {}\n'.format(job['recipe']))
+			retval = run_job(sock, rfile, job, out)
+			send(sock, {'type': 'done', 'status': retval})
+	finally:
+		rfile.close()
+		sock.close()
+
+def main():
+	parser = argparse.ArgumentParser(description='Runs recipes handed out by `buildall.py --listen`.')
+	parser.add_argument('address', metavar='HOST:PORT', help='address of the coordinator')
+	parser.add_argument('-C', '--directory', help='work directory holding recipes/, stage/ and packages/, defaults to the current one')
+	parser.add_argument('-n', '--name', default='{0}:{1}'.format(socket.gethostname(), os.getpid()), help='name of this worker in the coordinator\'s log')
+	args = parser.parse_args()
+
+	if args.directory:
+		try: os.makedirs(args.directory)
+		except OSError: pass
+		os.chdir(args.directory)
+	run_worker(parse_address(args.address), args.name)
+
+if __name__ == '__main__':
+	main()
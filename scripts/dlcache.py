@@ -0,0 +1,146 @@
+import os, sys, hashlib, archive, download
+from urllib.request import urlopen
+from contextlib import contextmanager
+try: import fcntl
+except ImportError: fcntl = None
+
+# files of unfinished downloads and recipes being written, which
+# eviction leaves alone
+PARTIAL = ('.part', '.part.json', '.tmp', '.lock')
+
+def default_root():
+	if 'TPM_CACHE' in os.environ:
+		return os.path.abspath(os.environ['TPM_CACHE'])
+	return os.path.join(os.path.expanduser('~'), '.tpm', 'cache')
+
+def recipe_cache():
+	return os.path.join(default_root(), 'recipes')
+
+def default_size():
+	if 'TPM_CACHE_SIZE' in os.environ:
+		return int(os.environ['TPM_CACHE_SIZE'])
+	return 2 * 1024 * 1024 * 1024
+
+def file_hash(path):
+	hash = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(64 * 1024), b''):
+			hash.update(chunk)
+	return hash.hexdigest()
+
+class ChecksumError(Exception):
+	def __init__(self, url, expected, actual):
+		Exception.__init__(self, '{0}: sha256 mismatch: expected {1}, got {2}'.format(url, expected, actual))
+		self.url = url
+		self.expected = expected
+		self.actual = actual
+
+class DownloadCache:
+	def __init__(self, root = None, max_size = None):
+		if root is None: root = default_root()
+		if max_size is None: max_size = default_size()
+		self.root = os.path.join(root, 'downloads')
+		self.recipes = os.path.join(root, 'recipes')
+		self.max_size = max_size
+
+	def key(self, url, sha256 = None):
+		key = url
+		if sha256: key += '\n' + sha256.lower()
+		return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+	def path(self, url, sha256 = None):
+		key = self.key(url, sha256)
+		return os.path.join(self.root, key[:2], key, os.path.basename(url.split('?', 1)[0]) or 'download')
+
+	def lookup(self, url, sha256 = None):
+		path = self.path(url, sha256)
+		if not os.path.exists(path): return None
+		os.utime(path, None)
+		return path
+
+	# one process or thread downloads a file while the others wait for it
+	@contextmanager
+	def locked(self, path):
+		if fcntl is None:
+			yield
+			return
+		with open(path + '.lock', 'w') as f:
+			fcntl.flock(f, fcntl.LOCK_EX)
+			try: yield
+			finally: fcntl.flock(f, fcntl.LOCK_UN)
+
+	# the file is cached under url, mirrors are only other places to get
+	# it from; an interrupted download is resumed by the next fetch
+	def fetch(self, url, sha256 = None, out = sys.stdout, mirrors = ()):
+		path = self.lookup(url, sha256)
+		if path is not None:
+			out.write('+ cached {}\n'.format(url))
+			return path
+
+		path = self.path(url, sha256)
+		dirname = os.path.dirname(path)
+		try: os.makedirs(dirname)
+		except: pass
+
+		with self.locked(path):
+			if self.lookup(url, sha256) is not None:
+				out.write('+ cached {}\n'.format(url))
+				return path
+			out.write('+ download {}\n'.format(url))
+			job = download.Download([url] + [mirror for mirror in mirrors if mirror != url], path, out, checked=bool(sha256))
+			tmp = job.run()
+			if sha256:
+				actual = file_hash(tmp)
+				if actual != sha256.lower():
+					job.discard()
+					raise ChecksumError(url, sha256, actual)
+			os.replace(tmp, path)
+
+		self.evict(keep = path)
+		return path
+
+	def stream_extract(self, url, sha256, dir, out = sys.stdout, mirrors = ()):
+		out.write('+ wget -O - {} | tar -x\n'.format(url))
+		hash = hashlib.sha256()
+		response = self.open_first([url] + list(mirrors), out)
+		try:
+			archive.extract_stream(archive.HashingReader(response, hash), dir)
+		finally:
+			response.close()
+		if sha256 and hash.hexdigest() != sha256.lower():
+			raise ChecksumError(url, sha256, hash.hexdigest())
+
+	# a stream cannot switch mirrors halfway, so only connecting falls back
+	def open_first(self, urls, out):
+		for url in urls[:-1]:
+			try: return urlopen(url, timeout=download.default_timeout())
+			except (IOError, OSError) as e:
+				out.write('+ {0}: {1}\n'.format(url, e))
+		return urlopen(urls[-1], timeout=download.default_timeout())
+
+	# parsed recipes from recipe_cache() count against the same size, so
+	# versions of recipes edited since are dropped with old downloads
+	def entries(self):
+		result = []
+		for top in (self.root, self.recipes):
+			for root, dirs, files in os.walk(top):
+				for filename in files:
+					if filename.endswith(PARTIAL): continue
+					path = os.path.join(root, filename)
+					try: st = os.stat(path)
+					except OSError: continue
+					result.append((st.st_mtime, st.st_size, path))
+		return result
+
+	def evict(self, keep = None):
+		entries = sorted(self.entries())
+		total = sum(entry[1] for entry in entries)
+		for mtime, size, path in entries:
+			if total <= self.max_size: break
+			if path == keep: continue
+			try:
+				os.remove(path)
+				if os.path.exists(path + '.lock'): os.remove(path + '.lock')
+				os.rmdir(os.path.dirname(path))
+			except OSError: pass
+			total -= size
@@ -0,0 +1,248 @@
+import os, sys, json, time, threading
+from urllib.request import Request, urlopen
+from urllib.error import URLError
+from http.client import HTTPException
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 64 * 1024
+# archives smaller than two segments are fetched in one piece
+MIN_SEGMENT = 4 * 1024 * 1024
+ATTEMPTS = 3
+SAVE_INTERVAL = 1.0
+SLOW_WINDOW = 10.0
+
+def default_segments():
+	return int(os.environ.get('TPM_DOWNLOAD_SEGMENTS', '4'))
+
+def default_timeout():
+	return float(os.environ.get('TPM_DOWNLOAD_TIMEOUT', '30'))
+
+def default_min_rate():
+	return int(os.environ.get('TPM_DOWNLOAD_MIN_RATE', '16384'))
+
+class DownloadError(Exception):
+	pass
+
+class SlowMirror(DownloadError):
+	pass
+
+class UpstreamChanged(DownloadError):
+	pass
+
+# every url gets ATTEMPTS tries; each segment starts on a different
+# mirror and moves on to the one which failed least so far
+class Mirrors:
+	def __init__(self, urls):
+		self.urls = list(urls)
+		self.failures = dict((url, 0) for url in self.urls)
+		self.lock = threading.Lock()
+
+	def pick(self, hint):
+		with self.lock:
+			live = [i for i, url in enumerate(self.urls) if self.failures[url] < ATTEMPTS]
+			if not live: return None
+			count = len(self.urls)
+			return self.urls[min(live, key=lambda i: (self.failures[self.urls[i]], (i - hint) % count))]
+
+	def failed(self, url):
+		with self.lock:
+			self.failures[url] += 1
+
+	def alternatives(self, url):
+		with self.lock:
+			return any(other != url and self.failures[other] < ATTEMPTS for other in self.urls)
+
+def content_range(response):
+	value = response.headers.get('Content-Range', '')
+	if not value.startswith('bytes '): return None
+	span, _, total = value[len('bytes '):].partition('/')
+	first, _, last = span.partition('-')
+	try: return int(first), int(last), int(total)
+	except ValueError: return None
+
+# a weak ETag cannot be used in If-Range
+def validator(response):
+	etag = response.headers.get('ETag')
+	if etag and not etag.startswith('W/'): return etag
+	return response.headers.get('Last-Modified')
+
+class Download:
+	# with checked set the caller verifies a checksum afterwards, so a
+	# download may be resumed from a server which sends no validator
+	def __init__(self, urls, path, out = sys.stdout, segments = None, timeout = None, min_rate = None, checked = False):
+		self.mirrors = Mirrors(urls)
+		self.checked = checked
+		self.part = path + '.part'
+		self.state_path = self.part + '.json'
+		self.out = out
+		self.segments = segments or default_segments()
+		self.timeout = timeout or default_timeout()
+		self.min_rate = default_min_rate() if min_rate is None else min_rate
+		self.lock = threading.Lock()
+		self.saved = 0
+		self.state = None
+		self.cancelled = threading.Event()
+
+	def warn(self, url, e):
+		self.out.write('+ {0}: {1}\n'.format(url, e or type(e).__name__))
+
+	def open(self, url, first = None, last = None, if_range = None):
+		request = Request(url)
+		if first is not None:
+			request.add_header('Range', 'bytes={0}-{1}'.format(first, '' if last is None else last))
+		if if_range is not None:
+			request.add_header('If-Range', if_range)
+		return urlopen(request, timeout=self.timeout)
+
+	def probe(self):
+		while True:
+			url = self.mirrors.pick(0)
+			if url is None: raise DownloadError('no mirror answered')
+			try:
+				response = self.open(url, 0, 0)
+				try:
+					span = content_range(response)
+					if response.status == 206 and span is not None:
+						return span[2], url, validator(response)
+					size = response.headers.get('Content-Length')
+					return (int(size) if size else None), None, None
+				finally: response.close()
+			except (URLError, HTTPException, OSError, ValueError) as e:
+				self.warn(url, e)
+				self.mirrors.failed(url)
+
+	# the saved bytes are only kept if the file is known to be the same:
+	# by the validator of the same url, or by the caller's checksum
+	def load_state(self, size, url, validator):
+		try:
+			with open(self.state_path) as f:
+				state = json.load(f)
+			if state['size'] != size or os.path.getsize(self.part) != size:
+				return None
+		except (IOError, OSError, ValueError, KeyError):
+			return None
+		if state.get('url') == url and state.get('validator') is not None:
+			return state if state['validator'] == validator else None
+		return state if self.checked else None
+
+	def save_state(self, force = False):
+		if self.state is None: return
+		now = time.time()
+		if not force and now - self.saved < SAVE_INTERVAL: return
+		self.saved = now
+		tmp = self.state_path + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump(self.state, f)
+		os.replace(tmp, self.state_path)
+
+	def split(self, size):
+		count = max(1, min(self.segments, size // MIN_SEGMENT))
+		step = size // count
+		bounds = [i * step for i in range(count)] + [size]
+		return [[bounds[i], bounds[i + 1] - 1, 0] for i in range(count)]
+
+	def fetch_segment(self, index):
+		segment = self.state['segments'][index]
+		while segment[0] + segment[2] <= segment[1] and not self.cancelled.is_set():
+			url = self.mirrors.pick(index)
+			if url is None: raise DownloadError('all mirrors failed')
+			first = segment[0] + segment[2]
+			if_range = self.state.get('validator') if url == self.state.get('url') else None
+			try:
+				response = self.open(url, first, segment[1], if_range)
+				try:
+					if if_range is not None and response.status == 200:
+						raise UpstreamChanged('{} changed since the download started'.format(url))
+					span = content_range(response)
+					if response.status != 206 or span is None or span[0] != first or span[2] != self.state['size']:
+						raise DownloadError('server ignored the requested range')
+					self.copy(response, segment, url)
+				finally: response.close()
+			except UpstreamChanged:
+				raise
+			except (URLError, HTTPException, OSError, DownloadError) as e:
+				self.warn(url, e)
+				self.mirrors.failed(url)
+
+	def copy(self, response, segment, url):
+		start = time.time()
+		received = 0
+		# unbuffered, so the state file never counts bytes a killed
+		# process did not write yet
+		with open(self.part, 'r+b', buffering=0) as f:
+			f.seek(segment[0] + segment[2])
+			while segment[0] + segment[2] <= segment[1]:
+				if self.cancelled.is_set(): return
+				data = response.read(min(CHUNK_SIZE, segment[1] - segment[0] - segment[2] + 1))
+				if not data: raise DownloadError('connection closed early')
+				f.write(data)
+				received += len(data)
+				with self.lock:
+					segment[2] += len(data)
+					self.save_state()
+				elapsed = time.time() - start
+				if elapsed > SLOW_WINDOW:
+					if received / elapsed < self.min_rate and self.mirrors.alternatives(url):
+						raise SlowMirror('{0:.0f} bytes/s, trying another mirror'.format(received / elapsed))
+					start, received = time.time(), 0
+
+	def fetch_whole(self):
+		while True:
+			url = self.mirrors.pick(0)
+			if url is None: raise DownloadError('all mirrors failed')
+			try:
+				response = self.open(url)
+				try:
+					with open(self.part, 'wb') as f:
+						for data in iter(lambda: response.read(CHUNK_SIZE), b''):
+							f.write(data)
+					return
+				finally: response.close()
+			except (URLError, HTTPException, OSError) as e:
+				self.warn(url, e)
+				self.mirrors.failed(url)
+
+	def run(self):
+		size, url, validator = self.probe()
+		if url is None or not size:
+			self.fetch_whole()
+			return self.part
+
+		self.state = self.load_state(size, url, validator)
+		if self.state is not None:
+			done = sum(segment[2] for segment in self.state['segments'])
+			self.out.write('+ resuming at {0} of {1} bytes\n'.format(done, size))
+		else:
+			self.state = {'size': size, 'url': url, 'validator': validator, 'segments': self.split(size)}
+			with open(self.part, 'wb') as f:
+				f.truncate(size)
+			self.save_state(True)
+
+		pending = [i for i, segment in enumerate(self.state['segments']) if segment[0] + segment[2] <= segment[1]]
+		# one failed segment, or an interrupt, stops the others; what they
+		# got so far stays in the state file
+		pool = ThreadPoolExecutor(max_workers=max(len(pending), 1))
+		try:
+			for future in [pool.submit(self.fetch_segment, i) for i in pending]:
+				future.result()
+		except UpstreamChanged:
+			self.cancelled.set()
+			pool.shutdown()
+			# what was saved is part of the old file; the next run starts over
+			self.state = None
+			self.discard()
+			raise
+		except BaseException:
+			self.cancelled.set()
+			raise
+		finally:
+			pool.shutdown()
+			with self.lock:
+				self.save_state(True)
+		os.remove(self.state_path)
+		return self.part
+
+	def discard(self):
+		for path in (self.part, self.state_path):
+			try: os.remove(path)
+			except OSError: pass
@@ -0,0 +1,57 @@
+import os, re
+
+# GNU make jobserver: a pipe holding one byte for every job that may
+# start in addition to the one each process already runs as
+AUTH = re.compile(r'--jobserver-(?:auth|fds)=(?:(\d+),(\d+)|fifo:(\S+))')
+JOBS = re.compile(r'(?:^|\s)-j(\d+)')
+
+def default_cores():
+	return os.cpu_count() or 1
+
+class JobServer:
+	def __init__(self, tokens, reserved = 1, fds = None):
+		self.tokens = max(tokens, 1)
+		self.fds = fds
+		if fds is None and os.name == 'posix':
+			self.fds = os.pipe()
+			os.write(self.fds[1], b'+' * (self.tokens - reserved))
+
+	@staticmethod
+	def from_environ(environ = os.environ):
+		flags = environ.get('MAKEFLAGS', '')
+		auth = AUTH.search(flags)
+		jobs = JOBS.search(flags)
+		if auth is None or jobs is None: return None
+		try:
+			if auth.group(3):
+				fd = os.open(auth.group(3), os.O_RDWR)
+				fds = (fd, fd)
+			else:
+				fds = (int(auth.group(1)), int(auth.group(2)))
+				os.fstat(fds[0])
+				os.fstat(fds[1])
+		except OSError:
+			return None
+		return JobServer(int(jobs.group(1)), fds=fds)
+
+	def acquire(self):
+		if self.fds is None: return None
+		return os.read(self.fds[0], 1)
+
+	def release(self, token):
+		if token: os.write(self.fds[1], token)
+
+	def makeflags(self):
+		if self.fds is None:
+			return '-j{}'.format(self.tokens)
+		return '-j{0} --jobserver-fds={1},{2} --jobserver-auth={1},{2}'.format(self.tokens, *self.fds)
+
+	def environ(self):
+		env = dict(os.environ)
+		env['MAKEFLAGS'] = self.makeflags()
+		env.pop('MFLAGS', None)
+		return env
+
+	def pass_fds(self):
+		if self.fds is None: return ()
+		return tuple(set(self.fds))
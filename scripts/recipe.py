@@ -1,6 +1,17 @@
-import os, sys, re, shlex
+import os, sys, re, shlex, pickle, hashlib
+from urllib.parse import quote, unquote
 from collections import namedtuple
 
+# bump whenever a change to the parser would produce a different Recipe
+# from the same text, so stale entries in the compiled-recipe cache are
+# not picked up
+PARSER_VERSION = 4
+
+# $jobs and $cmake are filled in when the command runs, so that neither
+# the number of cores nor the compiler cache change build stamps
+JOBS = '@jobs@'
+CMAKE = '@cmake@'
+
 TEXT = 0
 CALL = 1
 VARIABLE = 2
@@ -12,27 +23,27 @@ Variable = namedtuple('Variable', ['pos', 'name', 'value'])
 Text = namedtuple('Text', ['pos', 'text'])
 
 class Tokenizer:
-	varname = re.compile('^([a-zA-Z_][a-zA-Z0-9_]*)(.*)$')
+	varname = re.compile(r'^([a-zA-Z_][a-zA-Z0-9_]*)(.*)$')
+	preproc = re.compile(r'^\%([a-zA-Z_][a-zA-Z0-9_]*)\s*(.*)$')
+	cmd = re.compile(r'^([a-zA-Z_][a-zA-Z0-9_]*)\s*:\s*(.*)$')
+	var = re.compile(r'^([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*(.*)$')
+
 	def __init__(self):
-		self.preproc = re.compile('^\%([a-zA-Z_][a-zA-Z0-9_]*)\s*(.*)$')
-		self.cmd = re.compile('^([a-zA-Z_][a-zA-Z0-9_]*)\s*:\s*(.*)$')
-		self.var = re.compile('^([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*(.*)$')
 		self.line = 0
-		self.text = ''
+		self.parts = []
 
 	def next_line(self, line):
 		line = line.split('#', 1)[0].strip()
 
 		self.line += 1
-		self.text += line
-
-		l = len(self.text)
-		if l and self.text[l - 1] == '\\':
-			self.text = self.text[:l - 1]
+		if line[-1:] == '\\':
+			self.parts.append(line[:-1])
 			return
 
-		line = self.text
-		self.text = ''
+		if self.parts:
+			self.parts.append(line)
+			line = ''.join(self.parts)
+			self.parts = []
 
 		if line == '': return
 		m = self.preproc.match(line)
@@ -131,6 +142,9 @@ class If:
 def do_escape(arg):
 	return '"' + arg.replace('\\', '\\\\').replace('!','\!') + '"'
 
+def version_key(version):
+	return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.split('[.-]', version)]
+
 def escape(arg):
 	if arg == "": return '""'
 	if '\\' in arg: return do_escape(arg)
@@ -186,7 +200,8 @@ class RecipeBuilder:
 		self.building = -1
 		self.ifstack = []
 
-		self.vars['cmake'] = 'cmake'
+		self.vars['cmake'] = CMAKE
+		self.vars['jobs'] = JOBS
 		if is_unix():
 			self.dir = 'posix'
 			self.vars['mkdir'] = 'mkdir -p'
@@ -321,24 +336,30 @@ class RecipeBuilder:
 			self.throw('Expecting %package')
 		self.package.provides.extend(self.split(dependencies))
 
+	def mirrors(self, urls):
+		if self.package is not None:
+			self.throw('Mirrors must come before the first %package')
+		self.props.setdefault('mirrors', []).extend(self.split(urls))
+
 	def expand(self, value):
 		if '$' not in value:
 			return value
 
 		value = value.split('$')
-		out = value[0]
-		value = value[1:]
-		for t in value:
+		out = [value[0]]
+		for t in value[1:]:
 			if t == '':
 				continue
 			if t[0] == '{':
 				t = t[1:].split('}', 1)
-				out += self.getvalue(t[0]) + t[1]
+				out.append(self.getvalue(t[0]))
+				out.append(t[1])
 				continue
 			m = Tokenizer.varname.match(t)
 			if m:
-				out += self.getvalue(m.group(1)) + m.group(2)
-		return out
+				out.append(self.getvalue(m.group(1)))
+				out.append(m.group(2))
+		return ''.join(out)
 
 	def getvalue(self, name):
 		if name in self.props:
@@ -384,15 +405,18 @@ RecipeBuilder.calls = {
 	'Pack': RecipeBuilder.pack,
 	'Requires': RecipeBuilder.requires,
 	'Provides': RecipeBuilder.provides,
+	'Mirrors': RecipeBuilder.mirrors,
 }
 
-RecipeBuilder.props = ['Name', 'Version', 'Upstream']
+RecipeBuilder.props = ['Name', 'Version', 'Upstream', 'Sha256']
 
 class ManifestBuilder:
 	def __init__(self):
 		self.props = {}
 		self.requires = []
 		self.provides = []
+		self.files = []
+		self.links = []
 		self.pos = 1
 
 	def mkerror(self, message, embed = None, pos = -1):
@@ -418,6 +442,16 @@ class ManifestBuilder:
 
 	def on_requires(self, name): self.requires.append(name)
 	def on_provides(self, name): self.provides.append(name)
+	def on_file(self, value):
+		entry = value.split(' ', 2)
+		if len(entry) != 3 or not entry[1].isdigit():
+			self.throw('Expecting `File: <sha256> <size> <path>`')
+		self.files.append((unquote(entry[2]), int(entry[1]), entry[0]))
+	def on_link(self, value):
+		entry = value.split(' -> ')
+		if len(entry) != 2:
+			self.throw('Expecting `Link: <path> -> <target>`')
+		self.links.append((unquote(entry[0]), unquote(entry[1])))
 
 	def build(self):
 		if 'id' not in self.props: self.throw('Id missing')
@@ -426,23 +460,75 @@ class ManifestBuilder:
 		if 'platform' not in self.props: self.throw('Plaform missing')
 		self.props['requires'] = self.requires
 		self.props['provides'] = self.provides
+		self.props['files'] = self.files
+		self.props['links'] = self.links
 		return self.props
 
 ManifestBuilder.calls = {
 	'Requires': ManifestBuilder.on_requires,
 	'Provides': ManifestBuilder.on_provides,
+	'File': ManifestBuilder.on_file,
+	'Link': ManifestBuilder.on_link,
 }
 
 ManifestBuilder.props = ['Id', 'Name', 'Version', 'Platform']
 
-def parse_recipe(path):
+def recipe_key(builder, contents):
+	key = hashlib.sha256()
+	key.update('{0}\n{1}\n{2}\n{3}\n'.format(PARSER_VERSION,
+		sorted(builder.macros.items()), sorted(builder.vars.items()), sorted(builder.props.items())).encode('utf-8'))
+	key.update(contents.encode('utf-8'))
+	return key.hexdigest()
+
+# a hit counts as a use for the download cache's eviction
+def load_cached(path):
+	try:
+		with open(path, 'rb') as f:
+			result = pickle.load(f)
+		os.utime(path, None)
+		return result
+	except Exception:
+		return None
+
+def store_cached(path, result):
+	try:
+		try: os.makedirs(os.path.dirname(path))
+		except OSError: pass
+		tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+		with open(tmp, 'wb') as f:
+			pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp, path)
+	except (IOError, OSError):
+		pass
+
+def parse_recipe(path, cache_dir = None):
 	tokens = Tokenizer()
 	builder = RecipeBuilder(path)
 	with open(path) as f:
-		for line in f:
-			for tok in tokens.next_line(line):
-				builder.use(tok)
-	return builder.build()
+		contents = f.read()
+
+	cached = None
+	if cache_dir is not None:
+		key = recipe_key(builder, contents)
+		cached = os.path.join(cache_dir, key[:2], key + '.pickle')
+		result = load_cached(cached)
+		if isinstance(result, Recipe):
+			return result
+
+	for line in contents.splitlines():
+		for tok in tokens.next_line(line):
+			builder.use(tok)
+	result = builder.build()
+
+	if cached is not None:
+		store_cached(cached, result)
+	return result
+
+def file_entry(path, size, sha256):
+	return u'File: {0} {1} {2}\n'.format(sha256, size, quote(path, safe='/'))
+
+def link_entry(path, target):
+	return u'Link: {0} -> {1}\n'.format(quote(path, safe='/'), quote(target, safe='/'))
 
 def parse_manifset(contents):
 	tokens = Tokenizer()
@@ -0,0 +1,234 @@
+import os, sys, gzip, asyncio, hashlib, argparse, threading
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import unquote, urlsplit
+import buildrepo
+
+CHUNK_SIZE = 64 * 1024
+MAX_HEADERS = 100
+COMPRESSIBLE = ['.xml', '.json']
+TYPES = {'.xml': 'application/xml', '.json': 'application/json'}
+
+class Resource:
+	def __init__(self, path, st, etag):
+		self.path = path
+		self.size = st.st_size
+		self.mtime = st.st_mtime
+		self.etag = etag
+		self.gzip = None
+		self.gzip_etag = None
+
+	def compress(self):
+		with open(self.path, 'rb') as f:
+			self.gzip = gzip.compress(f.read(), 9, mtime=0)
+		self.gzip_etag = self.etag[:-1] + '-gz"'
+
+# everything about a file the responses need, computed once for every
+# version of the file: package archives are tagged with their Id from
+# buildrepo.py's manifest cache, other files with their sha256; index
+# files are kept gzipped in memory
+class Repo:
+	def __init__(self, root):
+		self.root = os.path.abspath(root)
+		self.resources = {}
+		self.manifests = None
+		self.manifests_stamp = None
+		self.lock = threading.Lock()
+
+	def resolve(self, target):
+		path = unquote(urlsplit(target).path)
+		parts = [part for part in path.split('/') if part not in ('', '.')]
+		if '..' in parts or any('\0' in part or os.sep in part for part in parts):
+			return None, None
+		return '/'.join(parts), os.path.join(self.root, *parts)
+
+	def manifest_id(self, key, path):
+		cache_path = os.path.join(self.root, '.manifests.json')
+		try: st = os.stat(cache_path)
+		except OSError: return None
+		if self.manifests_stamp != (st.st_size, st.st_mtime):
+			self.manifests = buildrepo.ManifestCache(cache_path)
+			self.manifests_stamp = (st.st_size, st.st_mtime)
+		entry = self.manifests.get(key, path)
+		if entry is None or entry['manifest'] is None: return None
+		return entry['manifest']['id']
+
+	def lookup(self, target):
+		key, path = self.resolve(target)
+		if path is None: return None
+		if os.path.isdir(path):
+			key, path = key + '/index.xml', os.path.join(path, 'index.xml')
+		try: st = os.stat(path)
+		except OSError: return None
+		if not os.path.isfile(path): return None
+
+		with self.lock:
+			cached = self.resources.get(path)
+			if cached is not None and (cached.size, cached.mtime) == (st.st_size, st.st_mtime):
+				return cached
+			id = self.manifest_id(key.lstrip('/'), path)
+		if id is None:
+			hash = hashlib.sha256()
+			with open(path, 'rb') as f:
+				for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+					hash.update(data)
+			id = hash.hexdigest()
+		resource = Resource(path, st, '"{}"'.format(id))
+		if os.path.splitext(path)[1] in COMPRESSIBLE:
+			resource.compress()
+		with self.lock:
+			self.resources[path] = resource
+		return resource
+
+def parse_range(value, size):
+	if not value.startswith('bytes='): return None
+	ranges = value[len('bytes='):].split(',')
+	# several ranges would need a multipart response; the whole
+	# file is a valid answer to those
+	if len(ranges) != 1: return None
+	first, _, last = ranges[0].strip().partition('-')
+	try:
+		if not first:
+			length = int(last)
+			if length <= 0: return ()
+			return max(size - length, 0), size - 1
+		first = int(first)
+		last = int(last) if last else size - 1
+	except ValueError:
+		return None
+	if first >= size: return ()
+	if last < first: return None
+	return first, min(last, size - 1)
+
+def etag_matches(header, etags):
+	if header is None: return False
+	values = [value.strip() for value in header.split(',')]
+	return '*' in values or any(etag in values for etag in etags)
+
+def not_modified_since(header, mtime):
+	if header is None: return False
+	try: return int(mtime) <= parsedate_to_datetime(header).timestamp()
+	except (TypeError, ValueError, IndexError, OverflowError): return False
+
+class Server:
+	def __init__(self, repo, out = sys.stdout):
+		self.repo = repo
+		self.out = out
+
+	async def handle(self, reader, writer):
+		try:
+			while await self.request(reader, writer):
+				pass
+		except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+			pass
+		finally:
+			writer.close()
+
+	async def request(self, reader, writer):
+		line = await reader.readline()
+		if not line: return False
+		try:
+			method, target, version = line.decode('latin-1').split()
+		except ValueError:
+			await self.respond(writer, 400, 'Bad Request', {}, False)
+			return False
+		headers = {}
+		for count in range(MAX_HEADERS + 1):
+			header = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+			if not header: break
+			name, _, value = header.partition(':')
+			headers[name.strip().lower()] = value.strip()
+		else:
+			await self.respond(writer, 431, 'Request Header Fields Too Large', {}, False)
+			return False
+
+		keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+		if method not in ('GET', 'HEAD'):
+			await self.respond(writer, 405, 'Method Not Allowed', {'Allow': 'GET, HEAD'}, keep_alive)
+			return keep_alive
+
+		loop = asyncio.get_event_loop()
+		resource = await loop.run_in_executor(None, self.repo.lookup, target)
+		status = await self.serve(writer, method, resource, headers, keep_alive)
+		self.out.write('{0} {1} {2}\n'.format(method, target, status))
+		return keep_alive
+
+	async def respond(self, writer, status, reason, headers, keep_alive, body = b''):
+		headers = dict(headers)
+		if status != 304:
+			headers['Content-Length'] = str(headers.get('Content-Length', len(body)))
+		headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+		head = 'HTTP/1.1 {0} {1}\r\n'.format(status, reason)
+		head += ''.join('{0}: {1}\r\n'.format(name, headers[name]) for name in sorted(headers))
+		writer.write(head.encode('latin-1') + b'\r\n' + body)
+		await writer.drain()
+		return status
+
+	async def serve(self, writer, method, resource, headers, keep_alive):
+		if resource is None:
+			return await self.respond(writer, 404, 'Not Found', {}, keep_alive)
+
+		gzipped = resource.gzip is not None and 'gzip' in headers.get('accept-encoding', '')
+		etag = resource.gzip_etag if gzipped else resource.etag
+		common = {
+			'ETag': etag,
+			'Last-Modified': formatdate(resource.mtime, usegmt=True),
+			'Content-Type': TYPES.get(os.path.splitext(resource.path)[1], 'application/octet-stream'),
+		}
+		if resource.gzip is not None:
+			common['Vary'] = 'Accept-Encoding'
+
+		if 'if-none-match' in headers:
+			if etag_matches(headers['if-none-match'], [resource.etag, resource.gzip_etag]):
+				return await self.respond(writer, 304, 'Not Modified', common, keep_alive)
+		elif not_modified_since(headers.get('if-modified-since'), resource.mtime):
+			return await self.respond(writer, 304, 'Not Modified', common, keep_alive)
+
+		if gzipped:
+			common['Content-Encoding'] = 'gzip'
+			body = resource.gzip if method == 'GET' else b''
+			return await self.respond(writer, 200, 'OK', dict(common, **{'Content-Length': len(resource.gzip)}), keep_alive, body)
+
+		common['Accept-Ranges'] = 'bytes'
+		status, reason, first, length = 200, 'OK', 0, resource.size
+		span = None
+		if 'range' in headers and headers.get('if-range', etag) == etag:
+			span = parse_range(headers['range'], resource.size)
+		if span == ():
+			return await self.respond(writer, 416, 'Range Not Satisfiable',
+				dict(common, **{'Content-Range': 'bytes */{}'.format(resource.size), 'Content-Length': 0}), keep_alive)
+		if span:
+			status, reason = 206, 'Partial Content'
+			first, length = span[0], span[1] - span[0] + 1
+			common['Content-Range'] = 'bytes {0}-{1}/{2}'.format(span[0], span[1], resource.size)
+
+		await self.respond(writer, status, reason, dict(common, **{'Content-Length': length}), keep_alive)
+		if method == 'GET' and length:
+			with open(resource.path, 'rb') as f:
+				await asyncio.get_event_loop().sendfile(writer.transport, f, first, length)
+		return status
+
+async def serve_forever(repo, host, port, out):
+	server = Server(repo, out)
+	listener = await asyncio.start_server(server.handle, host, port)
+	for sock in listener.sockets:
+		out.write('+ serving {0} on http://{1}:{2}/\n'.format(repo.root, *sock.getsockname()[:2]))
+	out.flush()
+	async with listener:
+		await listener.serve_forever()
+
+def main():
+	parser = argparse.ArgumentParser(description='Serves packages/ to clients over HTTP.')
+	parser.add_argument('-b', '--bind', default='127.0.0.1', metavar='HOST', help='address to listen on, 127.0.0.1 by default')
+	parser.add_argument('-p', '--port', type=int, default=8000, help='port to listen on, 8000 by default')
+	parser.add_argument('-d', '--dir', default='packages', help='directory to serve, packages by default')
+	parser.add_argument('-q', '--quiet', action='store_true', help='do not log requests')
+	args = parser.parse_args()
+
+	out = open(os.devnull, 'w') if args.quiet else sys.stdout
+	try:
+		asyncio.run(serve_forever(Repo(args.dir), args.bind, args.port, out))
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,101 @@
+import os, json, hashlib, archive, chunkstore
+
+class StampDB:
+	def __init__(self, root = os.path.join('stage', 'stamps')):
+		self.root = root
+
+	def path(self, pkg):
+		return os.path.join(self.root, pkg.replace('\\', '/').replace('/', os.sep) + '.json')
+
+	def get(self, pkg):
+		try:
+			with open(self.path(pkg)) as f:
+				return json.load(f)
+		except (IOError, OSError, ValueError):
+			return None
+
+	def put(self, pkg, record):
+		path = self.path(pkg)
+		try: os.makedirs(os.path.dirname(path))
+		except OSError: pass
+		tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+		with open(tmp, 'w') as f:
+			json.dump(record, f, sort_keys=True, indent=1)
+		os.replace(tmp, path)
+
+	def records(self):
+		for root, dirs, files in os.walk(self.root):
+			for filename in files:
+				if not filename.endswith('.json'): continue
+				path = os.path.join(root, filename)
+				pkg = os.path.relpath(path, self.root)[:-len('.json')].replace(os.sep, '/')
+				record = self.get(pkg)
+				if record is not None:
+					yield pkg, record
+
+	def providers(self):
+		result = {}
+		for pkg, record in self.records():
+			for name in record.get('provides', []):
+				if name not in result:
+					result[name] = []
+				result[name].append((pkg, record['recipe'], record['id']))
+		return result
+
+def requirement_ids(conf, result, providers):
+	ids = set()
+	for pkg in result.packages:
+		for name in pkg.requires:
+			for _, recipe, id in providers.get(name, []):
+				if recipe != conf: ids.add(id)
+	return sorted(ids)
+
+def recipe_stamp(conf, result, dep_ids):
+	hash = hashlib.sha256()
+	with open(conf, 'rb') as f:
+		hash.update(f.read())
+	hash.update(u'\nupstream: {0} {1}\n'.format(result.props.get('upstream', ''), result.props.get('sha256', '')).encode('utf-8'))
+	for cmd in result.build:
+		hash.update(u'build: {}\n'.format(' '.join(cmd)).encode('utf-8'))
+	for id in dep_ids:
+		hash.update(u'requires: {}\n'.format(id).encode('utf-8'))
+	return hash.hexdigest()
+
+def package_id(path):
+	if os.path.exists(path):
+		arc = archive.open(path)
+		if arc is None: return None
+		try: manifest = arc.read('MANIFEST')
+		finally: arc.close()
+		if manifest is None: return None
+		manifest = manifest.decode('utf-8')
+	elif os.path.exists(path + chunkstore.EXT):
+		manifest = chunkstore.read_manifest(path + chunkstore.EXT)
+	else:
+		return None
+	head = manifest.split('\n', 1)[0]
+	if not head.startswith('Id: '): return None
+	return head[len('Id: '):]
+
+# size and mtime of the archive or its chunk list, recorded next to the
+# Id so that an untouched package is not opened again
+def package_stat(path):
+	for candidate in (path, path + chunkstore.EXT):
+		try: st = os.stat(candidate)
+		except OSError: continue
+		return [st.st_size, st.st_mtime]
+	return None
+
+def is_current(db, pkg, stamp):
+	record = db.get(pkg)
+	if record is None or record['stamp'] != stamp:
+		return False
+	path = os.path.join('packages', pkg)
+	stat = package_stat(path)
+	if stat is None: return False
+	if record.get('file') == stat: return True
+	if package_id(path) != record['id']: return False
+	# same package, copied or touched; remember its new stat
+	record['file'] = stat
+	db.put(pkg, record)
+	return True
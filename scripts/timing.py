@@ -0,0 +1,99 @@
+import os, sys, json, time, threading
+from contextlib import contextmanager
+
+# path of the trace being recorded; child processes inherit it and
+# append their events to the same file
+ENV = 'TPM_TRACE'
+
+named = set()
+
+def events_path():
+	return os.environ[ENV] + '.events'
+
+def enabled():
+	return ENV in os.environ
+
+def emit(event):
+	data = (json.dumps(event, sort_keys=True) + '\n').encode('utf-8')
+	fd = os.open(events_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+	try: os.write(fd, data)
+	finally: os.close(fd)
+
+def now():
+	return int(time.time() * 1000000)
+
+def name_process():
+	pid = os.getpid()
+	if pid in named: return
+	named.add(pid)
+	label = ' '.join([os.path.basename(sys.argv[0])] + sys.argv[1:])
+	emit({'ph': 'M', 'name': 'process_name', 'pid': pid, 'tid': 0, 'args': {'name': label}})
+
+@contextmanager
+def span(name, cat = 'phase', **args):
+	if not enabled():
+		yield
+		return
+	start = now()
+	try:
+		yield
+	finally:
+		name_process()
+		emit({'ph': 'X', 'name': name, 'cat': cat, 'ts': start, 'dur': now() - start,
+			'pid': os.getpid(), 'tid': threading.get_ident() % 1000000, 'args': args})
+
+def start(path):
+	if enabled(): return False
+	os.environ[ENV] = os.path.abspath(path)
+	try: os.remove(events_path())
+	except OSError: pass
+	return True
+
+def load_events(path):
+	events = []
+	try:
+		with open(path + '.events', 'rb') as f:
+			for line in f:
+				try: events.append(json.loads(line.decode('utf-8')))
+				except ValueError: pass
+	except (IOError, OSError):
+		pass
+	return events
+
+# spans of these categories are listed one by one, all others are
+# summed up by name
+ITEMS = [('recipe', 'slowest recipes'), ('archive', 'slowest archives')]
+
+def summary(events, out, top = 10):
+	spans = [event for event in events if event['ph'] == 'X']
+	items = dict(ITEMS)
+	for cat, title in ITEMS:
+		slowest = sorted((event for event in spans if event['cat'] == cat), key=lambda event: -event['dur'])
+		if not slowest: continue
+		out.write('{}:\n'.format(title))
+		for event in slowest[:top]:
+			out.write('  {0:10.3f}s  {1}\n'.format(event['dur'] / 1000000.0, event['name']))
+
+	phases = {}
+	for event in spans:
+		if event['cat'] in items: continue
+		total, count, longest = phases.get(event['name'], (0, 0, 0))
+		phases[event['name']] = (total + event['dur'], count + 1, max(longest, event['dur']))
+	if phases:
+		out.write('slowest phases:\n')
+		out.write('  {0:>11} {1:>6} {2:>11}  {3}\n'.format('total', 'count', 'longest', 'phase'))
+		for name in sorted(phases, key=lambda name: -phases[name][0])[:top]:
+			total, count, longest = phases[name]
+			out.write('  {0:10.3f}s {1:6} {2:10.3f}s  {3}\n'.format(total / 1000000.0, count, longest / 1000000.0, name))
+
+def finish(out = sys.stderr):
+	path = os.environ.pop(ENV)
+	events = load_events(path)
+	tmp = path + '.tmp'
+	with open(tmp, 'w') as f:
+		json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+	os.replace(tmp, path)
+	try: os.remove(path + '.events')
+	except OSError: pass
+	out.write('+ trace written to {}\n'.format(path))
+	summary(events, out)
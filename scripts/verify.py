@@ -0,0 +1,92 @@
+import os, sys, hashlib, argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import recipe
+
+CHUNK_SIZE = 64 * 1024
+
+def check_file(root, entry):
+	path, size, sha256 = entry
+	try:
+		f = open(os.path.join(root, *path.split('/')), 'rb')
+	except (IOError, OSError):
+		return 'missing'
+	with f:
+		actual = os.fstat(f.fileno()).st_size
+		if actual != size:
+			return 'size mismatch: expected {0}, got {1}'.format(size, actual)
+		hash = hashlib.sha256()
+		for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+			hash.update(chunk)
+	if hash.hexdigest() != sha256:
+		return 'sha256 mismatch'
+	return None
+
+def check_link(root, entry):
+	path, target = entry
+	path = os.path.join(root, *path.split('/'))
+	if not os.path.islink(path):
+		return 'not a symlink' if os.path.lexists(path) else 'missing'
+	actual = os.readlink(path)
+	if actual != target:
+		return 'link mismatch: expected {0}, got {1}'.format(target, actual)
+	return None
+
+def verify_tree(root, files, jobs = 4, fail_fast = False, links = ()):
+	problems = []
+	with ThreadPoolExecutor(max_workers=jobs) as pool:
+		running = dict((pool.submit(check_file, root, entry), entry[0]) for entry in files)
+		running.update((pool.submit(check_link, root, entry), entry[0]) for entry in links)
+		while running:
+			done, _ = wait(running, return_when=FIRST_COMPLETED)
+			for future in done:
+				path = running.pop(future)
+				problem = future.result()
+				if problem is not None:
+					problems.append((path, problem))
+			if problems and fail_fast:
+				for future in running: future.cancel()
+				break
+	return sorted(problems)
+
+def installed_manifests(prefix, names):
+	installed = os.path.join(prefix, '.tpm', 'installed')
+	if not names:
+		try: names = sorted(os.listdir(installed))
+		except OSError: names = []
+	for name in names:
+		path = os.path.join(installed, name)
+		with open(path, 'rb') as f:
+			yield path, f.read().decode('utf-8')
+
+def main():
+	parser = argparse.ArgumentParser(description='Checks installed or extracted files against the MANIFEST file table.')
+	parser.add_argument('root', help='install prefix, or the extracted tree with --manifest')
+	parser.add_argument('names', nargs='*', metavar='name', help='installed packages to check, defaults to all')
+	parser.add_argument('-m', '--manifest', help='check ROOT against this MANIFEST instead of installed packages')
+	parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 4, help='number of files hashed concurrently')
+	parser.add_argument('-x', '--fail-fast', action='store_true', help='stop at the first difference')
+	args = parser.parse_args()
+
+	if args.manifest:
+		with open(args.manifest, 'rb') as f:
+			manifests = [(args.manifest, f.read().decode('utf-8'))]
+	else:
+		manifests = installed_manifests(args.root, args.names)
+
+	failed = False
+	for path, text in manifests:
+		manifest = recipe.parse_manifset(text)
+		if not manifest['files'] and not manifest['links']:
+			sys.stderr.write('{0}: warning: no file table, skipping\n'.format(path))
+			continue
+		problems = verify_tree(args.root, manifest['files'], args.jobs, args.fail_fast, manifest['links'])
+		for name, problem in problems:
+			sys.stdout.write('{0}: {1}-{2}: {3}\n'.format(name, manifest['name'], manifest['version'], problem))
+		if problems:
+			failed = True
+			if args.fail_fast: break
+
+	if failed: exit(1)
+
+if __name__ == '__main__':
+	main()
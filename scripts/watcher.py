@@ -0,0 +1,120 @@
+import os, time, errno, select, struct, ctypes, ctypes.util
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+EVENT = struct.Struct('iIII')
+
+# changes arriving this soon after each other are reported together,
+# so that an editor saving a recipe or a build writing a package
+# causes one round of work
+SETTLE = 0.3
+POLL_INTERVAL = 1.0
+
+def walk(roots, ignore):
+	for root in roots:
+		for dir, dirs, files in os.walk(root):
+			dirs[:] = [name for name in dirs if not ignore(os.path.join(dir, name))]
+			yield dir, [os.path.join(dir, name) for name in files if not ignore(os.path.join(dir, name))]
+
+class InotifyWatcher:
+	def __init__(self, roots, ignore):
+		self.ignore = ignore
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1')
+		self.dirs = {}
+		for dir, files in walk(roots, ignore):
+			self.add(dir)
+
+	def add(self, dir):
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir), MASK)
+		if wd < 0:
+			if ctypes.get_errno() == errno.ENOENT: return
+			raise OSError(ctypes.get_errno(), 'inotify_add_watch', dir)
+		self.dirs[wd] = dir
+
+	def read(self, changed):
+		data = os.read(self.fd, 64 * 1024)
+		pos = 0
+		while pos < len(data):
+			wd, mask, cookie, size = EVENT.unpack_from(data, pos)
+			name = data[pos + EVENT.size:pos + EVENT.size + size].rstrip(b'\0')
+			pos += EVENT.size + size
+			if wd not in self.dirs: continue
+			if mask & IN_DELETE_SELF:
+				del self.dirs[wd]
+				continue
+			path = os.path.join(self.dirs[wd], os.fsdecode(name))
+			if self.ignore(path): continue
+			if mask & IN_ISDIR:
+				if mask & (IN_CREATE | IN_MOVED_TO):
+					for dir, files in walk([path], self.ignore):
+						self.add(dir)
+						changed.update(files)
+				continue
+			changed.add(path)
+
+	def wait(self, timeout = None):
+		changed = set()
+		deadline = None if timeout is None else time.time() + timeout
+		while True:
+			if changed:
+				wait = SETTLE
+			elif deadline is None:
+				wait = None
+			else:
+				wait = max(deadline - time.time(), 0)
+			ready, _, _ = select.select([self.fd], [], [], wait)
+			if not ready: return changed
+			self.read(changed)
+
+	def close(self):
+		os.close(self.fd)
+
+class PollingWatcher:
+	def __init__(self, roots, ignore):
+		self.roots = roots
+		self.ignore = ignore
+		self.files = self.snapshot()
+
+	def snapshot(self):
+		result = {}
+		for dir, files in walk(self.roots, self.ignore):
+			for path in files:
+				try: st = os.stat(path)
+				except OSError: continue
+				result[path] = (st.st_mtime, st.st_size)
+		return result
+
+	def wait(self, timeout = None):
+		deadline = None if timeout is None else time.time() + timeout
+		changed = set()
+		while True:
+			time.sleep(SETTLE if changed else POLL_INTERVAL)
+			files = self.snapshot()
+			found = set(path for path in set(files) | set(self.files) if files.get(path) != self.files.get(path))
+			self.files = files
+			if found:
+				changed |= found
+				continue
+			if changed or (deadline is not None and time.time() >= deadline):
+				return changed
+
+	def close(self):
+		pass
+
+def create(roots, ignore):
+	try:
+		return InotifyWatcher(roots, ignore)
+	except (OSError, AttributeError, TypeError):
+		return PollingWatcher(roots, ignore)
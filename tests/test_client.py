@@ -0,0 +1,101 @@
+import os, sys, io, hashlib, tarfile, tempfile, shutil, threading, functools, unittest
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import archive, recipe, buildrepo, client
+
+class Handler(SimpleHTTPRequestHandler):
+	def log_message(self, *args):
+		pass
+
+# members are (path, contents) for files and (path, None, target) for
+# symlinks, hashed into the Id the way build.py packs them
+def make_package(path, name, members, requires = ()):
+	hash = hashlib.sha256()
+	manifest = u'Name: {0}\nVersion: 1.0\nPlatform: POSIX\nProvides: {0}\n'.format(name)
+	for req in requires:
+		manifest += u'Requires: {}\n'.format(req)
+	links = u''
+	with tarfile.open(path, 'w:gz') as tar:
+		for member in members:
+			info = tarfile.TarInfo('files/' + member[0])
+			if member[1] is None:
+				info.type = tarfile.SYMTYPE
+				info.linkname = member[2]
+				archive.hash_link(hash, member[2])
+				links += recipe.link_entry(member[0], member[2])
+				tar.addfile(info)
+				continue
+			info.size = len(member[1])
+			hash.update(member[1])
+			manifest += recipe.file_entry(member[0], len(member[1]), hashlib.sha256(member[1]).hexdigest())
+			tar.addfile(info, io.BytesIO(member[1]))
+		manifest += links
+		hash.update(manifest.encode('utf-8'))
+		data = u'Id: {0}\n{1}'.format(hash.hexdigest(), manifest).encode('utf-8')
+		info = tarfile.TarInfo('MANIFEST')
+		info.size = len(data)
+		tar.addfile(info, io.BytesIO(data))
+
+class ClientTest(unittest.TestCase):
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.repo = os.path.join(self.root, 'repo')
+		self.prefix = os.path.join(self.root, 'prefix')
+		os.makedirs(os.path.join(self.repo, 'posix'))
+		self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=self.repo))
+		threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+		self.client = client.Client('http://127.0.0.1:{}/'.format(self.httpd.server_address[1]), self.prefix, 'POSIX', 2, io.StringIO())
+
+	def tearDown(self):
+		self.client.close()
+		self.httpd.shutdown()
+		self.httpd.server_close()
+		shutil.rmtree(self.root)
+
+	def package(self, name, members, requires = ()):
+		path = os.path.join(self.repo, 'posix', name + '-1.0.tar.gz')
+		make_package(path, name, members, requires)
+		return path
+
+	def refresh(self):
+		buildrepo.refresh(self.repo, buildrepo.ManifestCache(os.path.join(self.root, 'manifests.json')), out=io.StringIO())
+
+	def read(self, *parts):
+		with open(os.path.join(self.prefix, *parts), 'rb') as f:
+			return f.read()
+
+	def test_install_with_requirements(self):
+		self.package('libfoo', [('lib/libfoo.so.1', b'foo'), ('lib/libfoo.so', None, 'libfoo.so.1')])
+		self.package('bar', [('bin/bar', b'bar')], ['libfoo'])
+		self.refresh()
+		pkgs = self.client.install(['bar'])
+		self.assertEqual([pkg.name for pkg in pkgs], ['libfoo', 'bar'])
+		self.assertEqual(self.read('bin', 'bar'), b'bar')
+		self.assertEqual(os.readlink(os.path.join(self.prefix, 'lib', 'libfoo.so')), 'libfoo.so.1')
+		self.assertIsNotNone(self.client.installed('libfoo'))
+		# a second run finds everything installed
+		self.assertEqual(self.client.install(['bar']), [])
+
+	def test_id_mismatch(self):
+		path = self.package('foo', [('bin/foo', b'foo')])
+		self.refresh()
+		# a consistent package, but not the one repo.xml lists
+		make_package(path, 'foo', [('bin/foo', b'evil')])
+		with self.assertRaises(client.VerifyError) as e:
+			self.client.install(['foo'])
+		self.assertIn('expected Id', str(e.exception))
+		self.assertFalse(os.path.exists(os.path.join(self.prefix, 'bin', 'foo')))
+		self.assertIsNone(self.client.installed('foo'))
+
+	def test_chained_links_stay_in_prefix(self):
+		self.package('foo', [('x', None, '.'), ('x/y', None, '..'), ('x/y/evil', b'evil')])
+		self.refresh()
+		with self.assertRaises(client.VerifyError) as e:
+			self.client.install(['foo'])
+		self.assertIn('outside of the prefix', str(e.exception))
+		self.assertFalse(os.path.exists(os.path.join(self.root, 'evil')))
+		self.assertIsNone(self.client.installed('foo'))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,223 @@
+import os, sys, io, json, time, socket, hashlib, tempfile, shutil, threading, unittest
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import dlcache, download, recipe
+
+PAYLOAD = os.urandom(1024 * 1024)
+SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+# a local stand-in for an upstream server, which can refuse the first
+# requests, cut responses short, send slowly, ignore Range headers or
+# send an ETag and honour If-Range
+class Handler(BaseHTTPRequestHandler):
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		server = self.server
+		with server.lock:
+			server.requests.append(self.headers.get('Range'))
+			if server.errors:
+				server.errors -= 1
+				self.send_error(503)
+				return
+		payload = server.payload
+		first, last = 0, len(payload) - 1
+		value = self.headers.get('Range')
+		# probe_etag answers the probe for a file changed right after it
+		etag = server.probe_etag if value == 'bytes=0-0' and server.probe_etag else server.etag
+		if_range = self.headers.get('If-Range')
+		if value and server.ranges and (if_range is None or if_range == etag):
+			start, _, end = value[len('bytes='):].partition('-')
+			first, last = int(start), int(end) if end else last
+			self.send_response(206)
+			self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(first, last, len(payload)))
+		else:
+			self.send_response(200)
+		if etag: self.send_header('ETag', etag)
+		self.send_header('Content-Length', str(last - first + 1))
+		self.end_headers()
+
+		sent = 0
+		for pos in range(first, last + 1, 16 * 1024):
+			data = payload[pos:min(pos + 16 * 1024, last + 1)]
+			if server.cut is not None and sent + len(data) > server.cut and last > first:
+				self.wfile.write(data[:server.cut - sent])
+				self.wfile.flush()
+				self.connection.shutdown(socket.SHUT_RDWR)
+				self.close_connection = True
+				return
+			if server.delay: time.sleep(server.delay)
+			try: self.wfile.write(data)
+			except (ConnectionError, OSError): return
+			sent += len(data)
+
+class StandIn:
+	def __init__(self, errors = 0, cut = None, delay = 0, ranges = True, etag = None):
+		self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.httpd.lock = threading.Lock()
+		self.httpd.requests = []
+		self.httpd.errors = errors
+		self.httpd.cut = cut
+		self.httpd.delay = delay
+		self.httpd.ranges = ranges
+		self.httpd.payload = PAYLOAD
+		self.httpd.etag = etag
+		self.httpd.probe_etag = None
+		self.url = 'http://127.0.0.1:{}/foo-1.0.tar.gz'.format(self.httpd.server_address[1])
+		threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+	@property
+	def requests(self):
+		return self.httpd.requests
+
+	def close(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+class DownloadTest(unittest.TestCase):
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.cache = dlcache.DownloadCache(self.root, 1024 * 1024 * 1024)
+		self.servers = []
+		patches = [
+			mock.patch.object(download, 'MIN_SEGMENT', 128 * 1024),
+			mock.patch.object(download, 'SLOW_WINDOW', 0.2),
+			mock.patch.dict(os.environ, {'TPM_DOWNLOAD_SEGMENTS': '4', 'TPM_DOWNLOAD_TIMEOUT': '5'}),
+		]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def tearDown(self):
+		for server in self.servers:
+			server.close()
+		shutil.rmtree(self.root)
+
+	def server(self, **kwargs):
+		server = StandIn(**kwargs)
+		self.servers.append(server)
+		return server
+
+	def fetch(self, url, mirrors = (), sha256 = SHA256, payload = PAYLOAD):
+		out = io.StringIO()
+		try:
+			path = self.cache.fetch(url, sha256, out, mirrors)
+		finally:
+			self.log = out.getvalue()
+		with open(path, 'rb') as f:
+			self.assertEqual(f.read(), payload)
+		return path
+
+	def cut_short(self, server, sha256 = SHA256):
+		server.httpd.cut = 100 * 1024
+		with self.assertRaises(download.DownloadError):
+			self.cache.fetch(server.url, sha256, io.StringIO())
+		server.httpd.cut = None
+		del server.requests[:]
+
+	def leftovers(self):
+		return sorted(name for root, dirs, files in os.walk(self.root) for name in files if not name.endswith('.lock'))
+
+	def test_segments(self):
+		server = self.server()
+		self.fetch(server.url)
+		ranges = [value for value in server.requests if value != 'bytes=0-0']
+		self.assertEqual(len(ranges), 4)
+		self.assertEqual(self.leftovers(), ['foo-1.0.tar.gz'])
+
+	def test_service_unavailable_then_success(self):
+		server = self.server(errors=2)
+		self.fetch(server.url)
+		self.assertIn('503', self.log)
+
+	def test_unavailable_upstream_uses_mirror(self):
+		upstream = self.server(errors=100)
+		mirror = self.server()
+		self.fetch(upstream.url, [mirror.url])
+		# after the first failure every segment prefers the mirror
+		self.assertEqual(len(upstream.requests), 1)
+		self.assertEqual(len(mirror.requests), 5)
+
+	def test_cut_connection_resumes(self):
+		server = self.server(cut=100 * 1024)
+		with self.assertRaises(download.DownloadError):
+			self.cache.fetch(server.url, SHA256, io.StringIO())
+		state = self.cache.path(server.url, SHA256) + '.part.json'
+		with open(state) as f:
+			segments = json.load(f)['segments']
+		self.assertTrue(any(done for first, last, done in segments))
+
+		server.httpd.cut = None
+		del server.requests[:]
+		self.fetch(server.url)
+		self.assertIn('+ resuming at', self.log)
+		# every unfinished segment continues after the bytes it already had
+		expected = sorted('bytes={0}-{1}'.format(first + done, last) for first, last, done in segments if first + done <= last)
+		self.assertEqual(sorted(value for value in server.requests if value != 'bytes=0-0'), expected)
+		self.assertEqual(self.leftovers(), ['foo-1.0.tar.gz'])
+
+	def test_resume_checks_validator(self):
+		server = self.server(etag='"1"')
+		self.cut_short(server, None)
+		self.fetch(server.url, sha256=None)
+		self.assertIn('+ resuming at', self.log)
+		self.assertNotIn(None, server.requests)
+
+	def test_changed_upstream_starts_over(self):
+		server = self.server(etag='"1"')
+		self.cut_short(server, None)
+		server.httpd.payload = os.urandom(len(PAYLOAD))
+		server.httpd.etag = '"2"'
+		self.fetch(server.url, sha256=None, payload=server.httpd.payload)
+		self.assertNotIn('+ resuming at', self.log)
+
+	def test_changed_during_download(self):
+		server = self.server(etag='"1"')
+		self.cut_short(server, None)
+		server.httpd.payload = os.urandom(len(PAYLOAD))
+		server.httpd.etag = '"2"'
+		server.httpd.probe_etag = '"1"'
+		with self.assertRaises(download.UpstreamChanged):
+			self.cache.fetch(server.url, None, io.StringIO())
+		self.assertEqual(self.leftovers(), [])
+		server.httpd.probe_etag = None
+		self.fetch(server.url, sha256=None, payload=server.httpd.payload)
+
+	def test_no_validator_without_checksum_starts_over(self):
+		server = self.server()
+		self.cut_short(server, None)
+		self.fetch(server.url, sha256=None)
+		self.assertNotIn('+ resuming at', self.log)
+
+	def test_throttled_mirror_falls_back(self):
+		slow = self.server(delay=0.05)
+		fast = self.server()
+		with mock.patch.dict(os.environ, {'TPM_DOWNLOAD_MIN_RATE': str(4 * 1024 * 1024)}):
+			self.fetch(slow.url, [fast.url])
+		self.assertIn('trying another mirror', self.log)
+		self.assertGreater(len(fast.requests), 2)
+
+	def test_no_range_support(self):
+		server = self.server(ranges=False)
+		self.fetch(server.url)
+		self.assertEqual(server.requests, ['bytes=0-0', None])
+
+	def test_eviction_includes_recipe_pickles(self):
+		pickle = os.path.join(self.root, 'recipes', 'ab', 'ab.pickle')
+		recipe.store_cached(pickle, 'recipe')
+		os.utime(pickle, (0, 0))
+		self.cache.max_size = len(PAYLOAD)
+		self.fetch(self.server().url)
+		self.assertFalse(os.path.exists(pickle))
+
+	def test_checksum_mismatch_drops_partial(self):
+		server = self.server()
+		with self.assertRaises(dlcache.ChecksumError):
+			self.fetch(server.url, sha256='0' * 64)
+		self.assertEqual(self.leftovers(), [])
+
+if __name__ == '__main__':
+	unittest.main()
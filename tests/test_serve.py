@@ -0,0 +1,105 @@
+import os, sys, io, gzip, asyncio, hashlib, tempfile, shutil, threading, unittest
+import http.client as httplib
+from email.utils import formatdate
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import serve
+
+PAYLOAD = os.urandom(100 * 1024)
+INDEX = b'<?xml version="1.0" encoding="utf-8"?>\n<index>\n</index>\n' * 10
+
+class ServeTest(unittest.TestCase):
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		packages = os.path.join(self.root, 'packages')
+		os.makedirs(os.path.join(packages, 'posix'))
+		with open(os.path.join(packages, 'posix', 'foo-1.0.tar.gz'), 'wb') as f:
+			f.write(PAYLOAD)
+		with open(os.path.join(packages, 'index.xml'), 'wb') as f:
+			f.write(INDEX)
+		with open(os.path.join(self.root, 'secret'), 'wb') as f:
+			f.write(b'secret')
+
+		self.loop = asyncio.new_event_loop()
+		self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+		self.thread.start()
+		server = serve.Server(serve.Repo(packages), io.StringIO())
+		start = asyncio.start_server(server.handle, '127.0.0.1', 0)
+		self.listener = asyncio.run_coroutine_threadsafe(start, self.loop).result(5)
+		self.port = self.listener.sockets[0].getsockname()[1]
+
+	def tearDown(self):
+		asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result(5)
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+		self.loop.close()
+		shutil.rmtree(self.root)
+
+	# connections still open are cancelled, so no handler outlives the loop
+	async def stop(self):
+		self.listener.close()
+		await self.listener.wait_closed()
+		tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+
+	def get(self, path, **headers):
+		conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+		try:
+			conn.request('GET', path, headers=dict((name.replace('_', '-'), value) for name, value in headers.items()))
+			response = conn.getresponse()
+			return response, response.read()
+		finally: conn.close()
+
+	def test_range(self):
+		response, body = self.get('/posix/foo-1.0.tar.gz', Range='bytes=100-199')
+		self.assertEqual(response.status, 206)
+		self.assertEqual(response.getheader('Content-Range'), 'bytes 100-199/{}'.format(len(PAYLOAD)))
+		self.assertEqual(body, PAYLOAD[100:200])
+
+	def test_range_not_satisfiable(self):
+		response, body = self.get('/posix/foo-1.0.tar.gz', Range='bytes={}-'.format(len(PAYLOAD)))
+		self.assertEqual(response.status, 416)
+		self.assertEqual(response.getheader('Content-Range'), 'bytes */{}'.format(len(PAYLOAD)))
+
+	def test_revalidation(self):
+		response, body = self.get('/posix/foo-1.0.tar.gz')
+		self.assertEqual(response.status, 200)
+		self.assertEqual(body, PAYLOAD)
+		etag = response.getheader('ETag')
+		self.assertEqual(etag, '"{}"'.format(hashlib.sha256(PAYLOAD).hexdigest()))
+
+		response, body = self.get('/posix/foo-1.0.tar.gz', If_None_Match=etag)
+		self.assertEqual(response.status, 304)
+		self.assertEqual(body, b'')
+		response, body = self.get('/posix/foo-1.0.tar.gz', If_None_Match='"other"')
+		self.assertEqual(response.status, 200)
+
+		response, body = self.get('/posix/foo-1.0.tar.gz', If_Modified_Since=response.getheader('Last-Modified'))
+		self.assertEqual(response.status, 304)
+		response, body = self.get('/posix/foo-1.0.tar.gz', If_Modified_Since=formatdate(0, usegmt=True))
+		self.assertEqual(response.status, 200)
+
+	def test_gzip(self):
+		plain, body = self.get('/index.xml')
+		self.assertEqual(body, INDEX)
+		self.assertIsNone(plain.getheader('Content-Encoding'))
+
+		response, body = self.get('/index.xml', Accept_Encoding='gzip')
+		self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+		self.assertEqual(response.getheader('Vary'), 'Accept-Encoding')
+		self.assertEqual(gzip.decompress(body), INDEX)
+		etag = response.getheader('ETag')
+		self.assertEqual(etag, plain.getheader('ETag')[:-1] + '-gz"')
+
+		response, body = self.get('/index.xml', Accept_Encoding='gzip', If_None_Match=etag)
+		self.assertEqual(response.status, 304)
+
+	def test_outside_of_root(self):
+		for path in ('/../secret', '/posix/../../secret', '/%2e%2e/secret'):
+			response, body = self.get(path)
+			self.assertEqual(response.status, 404, path)
+
+if __name__ == '__main__':
+	unittest.main()